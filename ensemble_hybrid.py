@@ -1,17 +1,33 @@
 import sys
+import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import orjson
 import csv
 import time
+import queue
+import threading
+import functools
+import collections
+import pickle
 from datetime import datetime
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel
-from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtCore import QTimer, Qt, QObject, QThread, pyqtSignal, pyqtSlot
 import pyqtgraph as pg
 import numpy as np
 import joblib
+from joblib import parallel_backend
+from numba import njit
 from sklearn.ensemble import IsolationForest
-from river import anomaly, preprocessing, compose
-from sklearn.preprocessing import LabelEncoder # Explicitly import LabelEncoder for type hinting/clarity
+from sklearn.preprocessing import LabelEncoder, StandardScaler # Explicitly import for type hinting/clarity
+try:
+    # Optional: compiles the Isolation Forest into a native shared library for faster scoring
+    import treelite
+    import tl2cgen
+except ImportError:
+    treelite = None
+    tl2cgen = None
 
 # --- Configuration ---
 ESP32_IP = "192.168.4.1"  # IP address of your ESP32 Active Receiver (Node 1)
@@ -21,17 +37,181 @@ FETCH_INTERVAL_MS = 500  # How often to fetch data from ESP32 (in milliseconds)
 FORWARD_FILL_TIMEOUT_SECONDS = 60  # 1 minute timeout for forward filling in Standby Mode
 CSV_FILENAME_PREFIX = "anomaly_log_"
 MAX_NODES = 3 # Define the maximum number of nodes for color generation
+N_FEATURES = 5 # Model inputs: rain, soil, vibration, tilt, encoded MAC
+MAX_PLOT_POINTS = 500 # Length of each per-node plot history (ring buffer size)
+REDRAW_INTERVAL_MS = 1000 # How often series appended since the last repaint are pushed to the plots
+WARNING_COALESCE_SECONDS = 5.0 # An unchanged warning level is re-plotted at most this often
+CSV_FLUSH_EVERY_TICKS = 10 # Flush buffered CSV rows to disk every N fetch ticks
+CSV_BUFFER_BYTES = 65536 # Write buffer size for the CSV log file
+CSV_QUEUE_MAXSIZE = 10000 # Per-tick row batches the CSV writer thread may fall behind by
+IF_PREDICT_THREADS = min(4, os.cpu_count() or 1) # Threads used to score Isolation Forest trees in parallel
+
+# Ensemble thresholds (These should be tuned based on your data and models)
+ISO_ANOMALY_THRESHOLD = -0.05 # Isolation Forest: values below this are considered anomalous
+RIVER_ANOMALY_THRESHOLD = 0.9 # HalfSpaceTrees: scores lie in [0, 1]; values above this are considered anomalous
+WARNING_LEVEL_TEXT = ("Low", "Mid", "High") # Indexed by numerical warning level
+# Per-node record template for one tick; copied (not rebuilt) for every node
+_EMPTY_ROW = {
+    'nodeId': None,
+    'rain': None,
+    'soil': None,
+    'vibration': None,
+    'tilt': None,
+    'mac': None,
+    'iso_score': None,
+    'river_score': None,
+    'warning_level_numerical': 0, # Default to Low
+    'warning_level_text': "Low"
+}
+
+# Streaming HalfSpaceTrees (same defaults as river.anomaly.HalfSpaceTrees)
+HST_N_TREES = 10
+HST_HEIGHT = 8
+HST_WINDOW_SIZE = 250
+# Per-feature (low, high) ranges the random splits are drawn from: rain, soil, vibration, tilt, encoded MAC
+HST_FEATURE_LIMITS = [(0, 4095), (0, 4095), (0.0, 10.0), (0.0, 60.0), (0, MAX_NODES)]
 
 # File paths for pre-trained models and encoders
 ISOLATION_FOREST_MODEL_PATH = 'offline_isolation_forest.joblib'
 SCALER_PATH = 'offline_scaler.joblib'
 MAC_ENCODER_PATH = 'mac_encoder.joblib'
+STATE_PATH = 'ensemble_state.pkl' # Online model + last known node data, carried across restarts
+ISOLATION_FOREST_LIB_PATH = 'offline_isolation_forest.so' # Treelite-compiled predictor, rebuilt only when the model file is newer
 
 # --- PyQtGraph Global Configuration ---
 pg.setConfigOption('background', 'w') # White background
 pg.setConfigOption('foreground', 'k') # Black foreground (text, axes)
+pg.setConfigOptions(useOpenGL=True, antialias=False) # GPU-backed painting, no antialiasing for lower fill-rate
+
+@functools.lru_cache(maxsize=None)
+def _load_artifact(path, mmap_mode=None):
+    """Loads a joblib artifact once per process; with mmap_mode='r' its arrays are memory-mapped from disk."""
+    return joblib.load(path, mmap_mode=mmap_mode)
+
+@njit(cache=True)
+def warn_levels(iso, river, iso_thr, river_thr, out):
+    """Compiled ensemble vote over one tick of scores; NaN marks a missing score and never votes."""
+    for i in range(iso.size):
+        a = iso[i] < iso_thr
+        b = river[i] > river_thr
+        out[i] = 2 if (a and b) else (1 if (a or b) else 0)
+
+@njit(cache=True)
+def hst_score_and_learn(feats, l_mass, r_mass, split_attr, split_val, height, size_limit):
+    """Scores one sample against the reference masses, then adds it to the latest-window masses.
+
+    Trees are stored as implicit complete binary trees: node i has children 2i+1 and 2i+2.
+    Returns the raw mass-weighted depth sum (higher means more normal).
+    """
+    score = 0.0
+    for t in range(l_mass.shape[0]):
+        idx = 0
+        scoring = True
+        for d in range(height + 1):
+            if scoring:
+                score += r_mass[t, idx] * 2.0 ** d
+                if r_mass[t, idx] < size_limit:
+                    scoring = False
+            l_mass[t, idx] += 1.0
+            if d < height:
+                idx = 2 * idx + 1 if feats[split_attr[t, idx]] < split_val[t, idx] else 2 * idx + 2
+    return score
+
+class StreamingHalfSpaceTrees:
+    """NumPy/numba port of river.anomaly.HalfSpaceTrees for fixed-length feature vectors.
+
+    Same mass-based scoring and score scale as river (0 = normal, 1 = most anomalous), but the
+    forest lives in flat arrays so a score+learn step runs without per-node Python work.
+    Unlike river, split features are drawn uniformly rather than weighted by range width:
+    the limits are in raw units, so width weighting would leave vibration, tilt and MAC
+    almost never split next to the 0-4095 ADC channels.
+    """
+
+    def __init__(self, limits, n_trees=HST_N_TREES, height=HST_HEIGHT, window_size=HST_WINDOW_SIZE,
+                 padding=0.15, seed=None):
+        self.n_trees = n_trees
+        self.height = height
+        self.window_size = window_size
+        self.size_limit = 0.1 * window_size
+        self.max_score = n_trees * window_size * (2 ** (height + 1) - 1)
+        self.counter = 0
+        self.first_window = True
+
+        n_nodes = 2 ** (height + 1) - 1
+        n_internal = 2 ** height - 1
+        self.l_mass = np.zeros((n_trees, n_nodes)) # Mass of the window being filled
+        self.r_mass = np.zeros((n_trees, n_nodes)) # Mass of the last complete (reference) window
+        self.split_attr = np.zeros((n_trees, n_internal), dtype=np.int64)
+        self.split_val = np.zeros((n_trees, n_internal))
+
+        # Random padded splits, narrowing each feature's range down the tree as river does
+        rng = np.random.default_rng(seed)
+        limits = np.asarray(limits, dtype=np.float64)
+        for t in range(n_trees):
+            lows = np.empty((n_internal, len(limits)))
+            highs = np.empty((n_internal, len(limits)))
+            lows[0], highs[0] = limits[:, 0], limits[:, 1]
+            for idx in range(n_internal):
+                attr = rng.integers(len(limits)) # Uniform, not width-weighted (see class docstring)
+                a, b = lows[idx, attr], highs[idx, attr]
+                at = rng.uniform(a + padding * (b - a), b - padding * (b - a))
+                self.split_attr[t, idx] = attr
+                self.split_val[t, idx] = at
+                for child, low, high in ((2 * idx + 1, a, at), (2 * idx + 2, at, b)):
+                    if child < n_internal:
+                        lows[child], highs[child] = lows[idx], highs[idx]
+                        lows[child, attr], highs[child, attr] = low, high
+
+    def score_and_learn(self, x):
+        """Returns the anomaly score of x (scored before learning), then learns from it."""
+        raw = hst_score_and_learn(x, self.l_mass, self.r_mass, self.split_attr, self.split_val,
+                                  self.height, self.size_limit)
+        score = 0.0 if self.first_window else 1.0 - raw / self.max_score
+
+        # Window full: latest masses become the reference profile
+        self.counter += 1
+        if self.counter == self.window_size:
+            self.l_mass, self.r_mass = self.r_mass, self.l_mass
+            self.l_mass.fill(0.0)
+            self.counter = 0
+            self.first_window = False
+        return score
+
+class FetcherWorker(QObject):
+    """Polls the ESP32 on a background thread so a slow HTTP round-trip never blocks the GUI."""
+    dataReady = pyqtSignal(float, object) # (python_timestamp, decoded JSON payload)
+    fetchFailed = pyqtSignal(float, str) # (python_timestamp, error message)
+    modeSet = pyqtSignal(str, object) # (requested mode, decoded JSON reply)
+    modeFailed = pyqtSignal(str) # error message
+
+    def __init__(self, http):
+        super().__init__()
+        self.http = http # Only ever used from this worker's thread; requests.Session is not thread-safe
+
+    @pyqtSlot()
+    def fetch(self):
+        current_python_time = time.time() # Current time in seconds since epoch
+        try:
+            response = self.http.get(SENSOR_DATA_ENDPOINT, timeout=FETCH_INTERVAL_MS / 1000.0 + 1) # Add a buffer to timeout
+            response.raise_for_status()
+            self.dataReady.emit(current_python_time, orjson.loads(response.content))
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            self.fetchFailed.emit(current_python_time, str(e))
+
+    @pyqtSlot(str)
+    def set_mode(self, mode):
+        """Sends a TCP request to the ESP32 to change its operating mode."""
+        try:
+            response = self.http.get(f"{SET_MODE_ENDPOINT}?mode={mode}", timeout=5)
+            response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+            self.modeSet.emit(mode, orjson.loads(response.content))
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            self.modeFailed.emit(str(e))
 
 class EnsembleAnomalyApp(QWidget):
+    fetchRequested = pyqtSignal() # Asks the FetcherWorker for one poll
+    modeRequested = pyqtSignal(str) # Asks the FetcherWorker to switch the ESP32's mode
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Ensemble Hybrid Anomaly Detection System")
@@ -41,12 +221,27 @@ class EnsembleAnomalyApp(QWidget):
         self.csv_file = None
         self.csv_writer = None
         self.csv_filename = None
+        # CSV rows are written by a background thread; the GUI thread only queues each tick's batch.
+        # close_csv() drains the queue before swapping files, so the writer only ever sees an open file.
+        self._csv_queue = queue.Queue(maxsize=CSV_QUEUE_MAXSIZE)
+        self._csv_thread = threading.Thread(target=self._csv_worker, daemon=True)
+        self._csv_thread.start()
+        self._inflight = False # True while a fetch is outstanding on the worker thread
+        self._closing = False # Set by closeEvent; replies still queued from the worker are then ignored
+        self._dirty = set() # (sensor_type, node_id) series appended to since the last repaint
+        self._node_labels = {} # {node_id: legend label currently shown for the node's series}
+        self._last_warning = {} # {node_id: (level, time)} of the last point in the node's warning-level series
+        # Per-tick model input matrix, one float32 row per ready node, reused across ticks
+        self._X_buf = np.empty((MAX_NODES, N_FEATURES), dtype=np.float32)
 
         # Stores the last received data for each node, used for forward filling
         # Format: {node_id: {'timestamp': python_timestamp, 'rain': val, 'soil': val, 'vibration': val, 'tilt': val, 'mac': mac_address}}
         self.last_known_data = {}
+        # Node ids seen so far, plus the same ids as a sorted tuple (rebuilt only when a new node appears)
+        self._known_ids = set()
+        self._sorted_node_ids = ()
 
-        # Data for plotting: {sensor_type: {node_id: {'x': [], 'y': []}}}
+        # Data for plotting: {sensor_type: {node_id: {'x': ndarray, 'y': ndarray, 'n': count, 'head': write_index}}}
         self.plot_data = {
             'rain': {},
             'soil': {},
@@ -66,29 +261,43 @@ class EnsembleAnomalyApp(QWidget):
             'river_score': {},
             'warning_level': {}
         }
-        # Keep track of alert markings (scatter plots)
-        self.alert_scatter_items = {
-            'iso_score_alert': {},
-            'river_score_alert': {},
-            'ensemble_alert': {}
-        }
+        # Alert markings: one scatter item per alert plot, shared by all nodes (created in init_ui)
+        self.alert_scatter_items = {}
+        # Alert spots currently shown, oldest first: {alert_type: {node_id: deque of spot dicts}}
+        self._alert_spots = {'iso_score_alert': {}, 'river_score_alert': {}, 'ensemble_alert': {}}
+        self._alert_dirty = set() # Alert types with spots added since the last repaint
+
+        # Shared pens/brushes, created once instead of on every tick or first touch
+        # Line pens for every node the receiver can report (nodes are numbered 1..MAX_NODES),
+        # built once so plot creation never goes through intColor/mkPen
+        self._node_pens = {node_id: pg.mkPen(color=pg.intColor(node_id * 10, hues=MAX_NODES), width=2)
+                           for node_id in range(1, MAX_NODES + 1)}
+        self._brush_iso_alert = pg.mkBrush(255, 0, 0, 150)
+        self._brush_river_alert = pg.mkBrush(0, 0, 255, 150)
+        self._brush_mid = pg.mkBrush(255, 165, 0, 150) # Orange for Mid
+        self._brush_high = pg.mkBrush(255, 0, 0, 200) # Red for High
+
+        # Persistent HTTP session so every poll reuses the same keep-alive TCP connection
+        # to the ESP32 instead of paying a fresh handshake each tick.
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0)
+        self.http.mount("http://", adapter)
+        self.http.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
 
         # --- Load Pre-trained Models ---
         self.if_model: IsolationForest = None
-        self.scaler: preprocessing.StandardScaler = None
+        self.scaler: StandardScaler = None
         self.mac_encoder: LabelEncoder = None
         self.load_models()
 
-        # --- Initialize River HalfSpaceTrees Model (online learning) ---
+        # --- Initialize River-style HalfSpaceTrees Model (online learning) ---
         # Note: HalfSpaceTrees is an online learning model and does not directly "base" itself
         # on a pre-trained Isolation Forest model in terms of parameters.
         # It learns incrementally from the incoming data stream.
-        # The number of features will be inferred from the first data point it learns.
-        self.river_model = anomaly.HalfSpaceTrees( # Corrected from HalfSpaceTree to HalfSpaceTrees
-            seed=42 # Removed n_features argument
-        )
-        # For simplicity, we will feed the river model the raw sensor values + encoded MAC.
-        # River's HalfSpaceTrees has internal mechanisms to handle feature ranges.
+        self.river_model = StreamingHalfSpaceTrees(limits=HST_FEATURE_LIMITS, seed=42)
+        # For simplicity, we will feed the river model the raw sensor values + encoded MAC;
+        # HST_FEATURE_LIMITS gives it the expected range of each raw feature.
+        self.load_state() # Resume the warmed-up model from the previous session, if any
 
         self.init_ui()
         self.start_data_timer()
@@ -96,7 +305,8 @@ class EnsembleAnomalyApp(QWidget):
     def load_models(self):
         """Loads the pre-trained Isolation Forest model, scaler, and MAC encoder."""
         try:
-            self.if_model = joblib.load(ISOLATION_FOREST_MODEL_PATH)
+            self.if_model = _load_artifact(ISOLATION_FOREST_MODEL_PATH, mmap_mode='r')
+            self.if_model.n_jobs = -1 # Allow tree scoring to fan out across the joblib backend below
             print(f"Successfully loaded Isolation Forest model from {ISOLATION_FOREST_MODEL_PATH}")
         except FileNotFoundError:
             print(f"Error: Isolation Forest model not found at {ISOLATION_FOREST_MODEL_PATH}. Please ensure it exists.")
@@ -106,7 +316,7 @@ class EnsembleAnomalyApp(QWidget):
             self.if_model = None
         
         try:
-            self.scaler = joblib.load(SCALER_PATH)
+            self.scaler = _load_artifact(SCALER_PATH, mmap_mode='r')
             print(f"Successfully loaded Scaler from {SCALER_PATH}")
         except FileNotFoundError:
             print(f"Error: Scaler not found at {SCALER_PATH}. Please ensure it exists.")
@@ -116,7 +326,7 @@ class EnsembleAnomalyApp(QWidget):
             self.scaler = None
 
         try:
-            self.mac_encoder = joblib.load(MAC_ENCODER_PATH)
+            self.mac_encoder = _load_artifact(MAC_ENCODER_PATH)
             print(f"Successfully loaded MAC Encoder from {MAC_ENCODER_PATH}")
         except FileNotFoundError:
             print(f"Error: MAC Encoder not found at {MAC_ENCODER_PATH}. Please ensure it exists.")
@@ -128,6 +338,70 @@ class EnsembleAnomalyApp(QWidget):
         if not (self.if_model and self.scaler and self.mac_encoder):
             print("Warning: Not all models/preprocessors loaded. Anomaly detection might be limited.")
 
+        # StandardScaler parameters cached as float32 for the hot-path scaling expression;
+        # with_mean=False / with_std=False leave mean_ / scale_ unused or None, so fall back to identity
+        if self.scaler:
+            self._mean = (self.scaler.mean_.astype(np.float32) if self.scaler.with_mean
+                          else np.zeros(N_FEATURES, dtype=np.float32))
+            self._inv_scale = ((1.0 / self.scaler.scale_).astype(np.float32) if self.scaler.scale_ is not None
+                               else np.ones(N_FEATURES, dtype=np.float32))
+
+        # Compile the fixed Isolation Forest once into a native predictor (falls back to scikit-learn).
+        # The gcc build takes seconds, so a library newer than the model file is reused as is.
+        self._fil = None
+        if self.if_model and tl2cgen is not None:
+            try:
+                if not self._fil_lib_is_current():
+                    model = treelite.sklearn.import_model(self.if_model)
+                    tl2cgen.export_lib(model, toolchain='gcc', libpath=ISOLATION_FOREST_LIB_PATH,
+                                       params={'parallel_comp': 4})
+                    print(f"Compiled Isolation Forest predictor to {ISOLATION_FOREST_LIB_PATH}")
+                self._fil = tl2cgen.Predictor(ISOLATION_FOREST_LIB_PATH, nthread=min(2, IF_PREDICT_THREADS))
+            except Exception as e:
+                print(f"Warning: Could not compile Isolation Forest with Treelite: {e}. Using scikit-learn scoring.")
+                self._fil = None
+
+        # MAC -> encoded id lookup table, equivalent to mac_encoder.transform for the trained classes
+        self._mac_to_id = {mac: i for i, mac in enumerate(self.mac_encoder.classes_)} if self.mac_encoder else {}
+        # MACs first seen at runtime, in id order; saved with the online model so they keep their ids
+        self._mac_extra = []
+
+    def _fil_lib_is_current(self):
+        """True if the compiled predictor exists and was built after the Isolation Forest model was last written."""
+        try:
+            return os.path.getmtime(ISOLATION_FOREST_LIB_PATH) >= os.path.getmtime(ISOLATION_FOREST_MODEL_PATH)
+        except OSError:
+            return False # No library yet
+
+    def load_state(self):
+        """Restores the online HalfSpaceTrees model, last known node data and runtime MAC ids saved on the last exit."""
+        try:
+            with open(STATE_PATH, 'rb') as f:
+                state = pickle.load(f)
+            if isinstance(state.get('river'), StreamingHalfSpaceTrees):
+                self.river_model = state['river']
+            self.last_known_data = state.get('last_known', {})
+            self._known_ids = set(self.last_known_data)
+            self._sorted_node_ids = tuple(sorted(self._known_ids))
+            # Re-register runtime MACs in their original order so each keeps the id the model learned
+            for mac in state.get('mac_extra', ()):
+                if mac not in self._mac_to_id:
+                    self._mac_to_id[mac] = len(self._mac_to_id)
+                    self._mac_extra.append(mac)
+            print(f"Restored online model state from {STATE_PATH}")
+        except FileNotFoundError:
+            pass # First run: start cold
+        except Exception as e:
+            print(f"Error loading saved state from {STATE_PATH}: {e}. Starting with a fresh model.")
+
+    def save_state(self):
+        """Persists the online model, last known node data and runtime MAC ids so the next start skips the warm-up window."""
+        try:
+            with open(STATE_PATH, 'wb') as f:
+                pickle.dump({'river': self.river_model, 'last_known': self.last_known_data,
+                             'mac_extra': self._mac_extra}, f, protocol=5)
+        except (IOError, pickle.PicklingError) as e:
+            print(f"Error saving state to {STATE_PATH}: {e}")
 
     def init_ui(self):
         main_layout = QVBoxLayout()
@@ -191,8 +465,8 @@ class EnsembleAnomalyApp(QWidget):
         self.plot_river_score.addLegend()
         self.plot_river_score.setLabel('bottom', 'Time (seconds)')
         self.plot_river_score.setLabel('left', 'Score')
-        # HalfSpaceTrees scores are distances, typically > 0. Higher means more anomalous.
-        self.plot_river_score.setYRange(0, 100) # Adjust as per typical score distribution
+        # HalfSpaceTrees scores lie in [0, 1]. Higher means more anomalous.
+        self.plot_river_score.setYRange(0, 1)
 
         self.plot_warning_level = self.anomaly_plot_widget.addPlot(row=1, col=0, title="Ensemble Warning Level")
         self.plot_warning_level.addLegend()
@@ -202,41 +476,95 @@ class EnsembleAnomalyApp(QWidget):
         # Set custom tick labels for the warning level plot
         self.plot_warning_level.getAxis('left').setTicks([[(0, 'Low'), (1, 'Mid'), (2, 'High')]])
 
+        # (sensor_type, plot) pairs in display order, built once for the per-node update loops
+        self._sensor_plot_pairs = [
+            ('rain', self.plot_rain), ('soil', self.plot_soil),
+            ('vibration', self.plot_vibration), ('tilt', self.plot_tilt),
+            ('iso_score', self.plot_iso_score), ('river_score', self.plot_river_score),
+            ('warning_level', self.plot_warning_level)
+        ]
+        for _, plot_obj in self._sensor_plot_pairs:
+            # Paint at most one min/max pair per pixel column and skip points outside the view
+            plot_obj.setDownsampling(ds=True, auto=True, mode='peak')
+            plot_obj.setClipToView(True)
+
+        # Alert markers: a single pxMode scatter item per plot, so all nodes share one symbol atlas.
+        # Ensemble alert spots carry their own symbol/brush (triangle for Mid, diamond for High).
+        # Added after downsampling is set up, since PlotItem would also try to downsample them.
+        self.alert_scatter_items = {
+            'iso_score_alert': pg.ScatterPlotItem(pxMode=True, symbol='o', size=10, brush=self._brush_iso_alert, name='IF Anomaly'),
+            'river_score_alert': pg.ScatterPlotItem(pxMode=True, symbol='s', size=10, brush=self._brush_river_alert, name='River Anomaly'),
+            'ensemble_alert': pg.ScatterPlotItem(pxMode=True, size=12, name='Ensemble Alert')
+        }
+        self.plot_iso_score.addItem(self.alert_scatter_items['iso_score_alert'])
+        self.plot_river_score.addItem(self.alert_scatter_items['river_score_alert'])
+        self.plot_warning_level.addItem(self.alert_scatter_items['ensemble_alert'])
 
         self.setLayout(main_layout)
 
     def start_data_timer(self):
+        # HTTP polling lives on its own thread; decoded payloads are handed back to the GUI thread
+        # through signals, so model inference and pyqtgraph items are only ever touched here.
+        self.net_thread = QThread(self)
+        self.fetcher = FetcherWorker(self.http)
+        self.fetcher.moveToThread(self.net_thread)
+        self.fetcher.dataReady.connect(self._on_data)
+        self.fetcher.fetchFailed.connect(self._on_fetch_failed)
+        self.fetcher.modeSet.connect(self._on_mode_set)
+        self.fetcher.modeFailed.connect(self._on_mode_failed)
+        self.fetchRequested.connect(self.fetcher.fetch, Qt.QueuedConnection)
+        self.modeRequested.connect(self.fetcher.set_mode, Qt.QueuedConnection)
+        self.net_thread.start()
+
         self.timer = QTimer()
+        self.timer.setTimerType(Qt.PreciseTimer)
         self.timer.setInterval(FETCH_INTERVAL_MS)
-        self.timer.timeout.connect(self.fetch_and_update_data)
+        self.timer.timeout.connect(self._request_fetch)
         self.timer.start()
 
+        # Repaints run on their own, slower timer so rendering cost does not scale with the poll rate
+        self.redraw_timer = QTimer()
+        self.redraw_timer.setInterval(REDRAW_INTERVAL_MS)
+        self.redraw_timer.timeout.connect(self._redraw_dirty)
+        self.redraw_timer.start()
+
+    def _request_fetch(self):
+        """Timer slot: polls the ESP32 unless the previous request is still in flight."""
+        if self._inflight:
+            return # Skip this tick instead of queueing requests behind a slow ESP32
+        self._inflight = True
+        self.fetchRequested.emit()
+
     def set_mode(self, mode):
-        """Sends a TCP request to the ESP32 to change its operating mode."""
-        try:
-            response = requests.get(f"{SET_MODE_ENDPOINT}?mode={mode}", timeout=5)
-            response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-            data = response.json()
-            if data.get("status") == "success":
-                self.current_mode = mode.upper() + "_MODE"
-                self.mode_label.setText(f"Current Mode: {self.current_mode}")
-                print(f"Successfully set ESP32 to {self.current_mode}")
-                # Clear existing plot data when mode changes to avoid misleading graphs
-                self.clear_plot_data()
-                # Re-initialize CSV for new mode
-                self.close_csv()
-                self.open_csv()
-            else:
-                print(f"Failed to set mode: {data.get('error', 'Unknown error')}")
-        except requests.exceptions.RequestException as e:
-            print(f"Error setting mode: {e}")
+        """Asks the worker thread to change the ESP32's operating mode; the reply arrives in _on_mode_set."""
+        self.modeRequested.emit(mode)
+
+    def _on_mode_set(self, mode, data):
+        """Applies the ESP32's reply to a mode change request (GUI thread)."""
+        if self._closing:
+            return
+        if data.get("status") == "success":
+            self.current_mode = mode.upper() + "_MODE"
+            self.mode_label.setText(f"Current Mode: {self.current_mode}")
+            print(f"Successfully set ESP32 to {self.current_mode}")
+            # Clear existing plot data when mode changes to avoid misleading graphs
+            self.clear_plot_data()
+            # Re-initialize CSV for new mode
+            self.close_csv()
+            self.open_csv()
+        else:
+            print(f"Failed to set mode: {data.get('error', 'Unknown error')}")
+
+    def _on_mode_failed(self, error):
+        """Reports a failed mode change request (GUI thread)."""
+        print(f"Error setting mode: {error}")
 
     def open_csv(self):
         """Opens a new CSV file with a timestamp in its name for anomaly logs."""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.csv_filename = f"{CSV_FILENAME_PREFIX}{timestamp}.csv"
         try:
-            self.csv_file = open(self.csv_filename, 'w', newline='')
+            self.csv_file = open(self.csv_filename, 'w', newline='', buffering=CSV_BUFFER_BYTES)
             self.csv_writer = csv.writer(self.csv_file)
             # Write header for anomaly log
             header = ["Timestamp", "MAC Address", "Rain", "Soil", "Vibration", "Tilt",
@@ -251,407 +579,475 @@ class EnsembleAnomalyApp(QWidget):
     def close_csv(self):
         """Closes the current CSV file."""
         if self.csv_file:
+            self._csv_queue.join() # Let the writer thread finish every queued row first
             self.csv_file.close()
             print(f"Closed CSV file: {self.csv_filename}")
             self.csv_file = None
             self.csv_writer = None
             self.csv_filename = None
 
+    def _queue_csv_rows(self, rows):
+        """Hands one tick's CSV rows to the writer thread without blocking the GUI thread."""
+        try:
+            self._csv_queue.put_nowait(rows)
+        except queue.Full:
+            print(f"CSV writer is falling behind; dropped {len(rows)} rows")
+
+    def _csv_worker(self):
+        """CSV writer thread: writes queued row batches, flushing once every CSV_FLUSH_EVERY_TICKS of them."""
+        flush_counter = 0
+        while True:
+            rows = self._csv_queue.get()
+            try:
+                if rows is None: # Shutdown sentinel from closeEvent
+                    return
+                self.csv_writer.writerows(rows)
+                flush_counter += 1
+                if flush_counter >= CSV_FLUSH_EVERY_TICKS:
+                    self.csv_file.flush()
+                    flush_counter = 0
+            except Exception as e: # Keep consuming so close_csv()'s queue join can never hang
+                print(f"Error writing to CSV file: {e}")
+            finally:
+                self._csv_queue.task_done()
+
+    def _redraw_dirty(self):
+        """Redraw timer slot: pushes each series appended since the last repaint to its plot item once."""
+        for sensor_type, node_id in self._dirty:
+            x, y = self._plot_arrays(self.plot_data[sensor_type][node_id])
+            if sensor_type == 'warning_level':
+                # Coalesced warning points reach further back than the per-tick series; show the same window
+                start = np.searchsorted(x, self._oldest_x(self.plot_data['rain'][node_id]))
+                x, y = x[start:], y[start:]
+            self.plot_items[sensor_type][node_id].setData(x, y)
+        self._dirty.clear()
+        self._flush_alert_points()
+
+    def _flush_alert_points(self):
+        """Drops alert spots older than their node's oldest plotted point and redraws changed scatter items.
+
+        Keeping the markers inside the lines' time window stops them from stretching the score
+        plots' x auto-range over the whole session.
+        """
+        for alert_type, node_spots in self._alert_spots.items():
+            changed = alert_type in self._alert_dirty
+            for node_id, spots in node_spots.items():
+                oldest = self._oldest_x(self.plot_data['rain'][node_id])
+                while spots and spots[0]['pos'][0] < oldest:
+                    spots.popleft()
+                    changed = True
+            if changed:
+                self.alert_scatter_items[alert_type].setData(
+                    spots=[spot for spots in node_spots.values() for spot in spots]
+                )
+        self._alert_dirty.clear()
+
+    def _add_alert_spot(self, alert_type, node_id, spot):
+        """Queues an alert marker for the next repaint."""
+        spots = self._alert_spots[alert_type].get(node_id)
+        if spots is None:
+            spots = self._alert_spots[alert_type][node_id] = collections.deque()
+        spots.append(spot)
+        self._alert_dirty.add(alert_type)
+
     def clear_plot_data(self):
         """Clears all historical plot data and plot items."""
         # Clear sensor plots
-        for sensor_type in self.plot_data:
+        for sensor_type, plot_obj in self._sensor_plot_pairs:
             self.plot_data[sensor_type].clear()
-            for node_id in self.plot_items[sensor_type]:
-                plot_map = {
-                    'rain': self.plot_rain, 'soil': self.plot_soil,
-                    'vibration': self.plot_vibration, 'tilt': self.plot_tilt,
-                    'iso_score': self.plot_iso_score, 'river_score': self.plot_river_score,
-                    'warning_level': self.plot_warning_level
-                }
-                if sensor_type in plot_map:
-                    plot_map[sensor_type].removeItem(self.plot_items[sensor_type][node_id])
+            for plot_item in self.plot_items[sensor_type].values():
+                plot_obj.removeItem(plot_item)
             self.plot_items[sensor_type].clear()
+        self._dirty.clear()
+        self._node_labels.clear()
+        self._last_warning.clear()
         
-        # Clear scatter alert items
-        for alert_type in self.alert_scatter_items:
-            for node_id in self.alert_scatter_items[alert_type]:
-                # Scatter plot items are added to specific plots, so we need to remove them from there
-                if alert_type == 'iso_score_alert':
-                    self.plot_iso_score.removeItem(self.alert_scatter_items['iso_score_alert'][node_id])
-                elif alert_type == 'river_score_alert':
-                    self.plot_river_score.removeItem(self.alert_scatter_items['river_score_alert'][node_id])
-                elif alert_type == 'ensemble_alert':
-                    self.plot_warning_level.removeItem(self.alert_scatter_items['ensemble_alert'][node_id])
-            self.alert_scatter_items[alert_type].clear()
+        # Clear alert markers (the shared scatter items stay on their plots)
+        for alert_type, scatter_item in self.alert_scatter_items.items():
+            scatter_item.clear()
+            self._alert_spots[alert_type].clear()
+        self._alert_dirty.clear()
 
         self.last_known_data.clear() # Also clear last known data for forward filling
+        self._known_ids.clear()
+        self._sorted_node_ids = ()
+
+    def _node_pen(self, node_id):
+        """Returns the line pen for a node; ids beyond MAX_NODES get one built on first use."""
+        pen = self._node_pens.get(node_id)
+        if pen is None:
+            pen = self._node_pens[node_id] = pg.mkPen(color=pg.intColor(node_id * 10, hues=MAX_NODES), width=2)
+        return pen
+
+    def _new_plot_buffer(self, t0):
+        """Allocates a fixed-size ring buffer (plus reusable setData output arrays) for one (sensor, node) series.
+
+        t0 is the series' time baseline: x values are stored as seconds since t0,
+        so they can be handed to setData without any per-tick arithmetic.
+        """
+        return {'x': np.empty(MAX_PLOT_POINTS), 'y': np.empty(MAX_PLOT_POINTS), 'n': 0, 'head': 0, 't0': t0,
+                'x_out': np.empty(MAX_PLOT_POINTS), 'y_out': np.empty(MAX_PLOT_POINTS)}
+
+    def _append_plot_point(self, buf, t, value):
+        """Writes a point at the ring buffer head, overwriting the oldest point once full."""
+        head = buf['head']
+        buf['x'][head] = t - buf['t0']
+        buf['y'][head] = value
+        buf['head'] = (head + 1) % MAX_PLOT_POINTS
+        buf['n'] = min(buf['n'] + 1, MAX_PLOT_POINTS)
+
+    def _oldest_x(self, buf):
+        """Returns the relative time of the oldest point still held in a ring buffer."""
+        return buf['x'][buf['head']] if buf['n'] == MAX_PLOT_POINTS else buf['x'][0]
+
+    def _append_warning_point(self, node_id, t, level):
+        """Appends to a node's warning-level series only when the level changes or has been
+        unchanged for WARNING_COALESCE_SECONDS. Returns True if any point was written.
+
+        A change is written as a step edge (old level, then new level, both at t), so the
+        plotted line keeps its step shape even though steady stretches are not sampled.
+        """
+        buf = self.plot_data['warning_level'][node_id]
+        last = self._last_warning.get(node_id)
+        if last is not None:
+            last_level, last_t = last
+            if level == last_level:
+                if t - last_t < WARNING_COALESCE_SECONDS:
+                    return False # Still the same level: nothing new to draw
+            else:
+                self._append_plot_point(buf, t, last_level)
+        self._append_plot_point(buf, t, level)
+        self._last_warning[node_id] = (level, t)
+        return True
 
+    def _plot_arrays(self, buf):
+        """Returns (relative_time, values) in chronological order, ready for setData.
 
-    def get_warning_level(self, iso_score, river_score):
+        The points are always copied into the buffer's preallocated output arrays, so plot
+        items never hold views into the live ring buffer and the update path does not allocate.
         """
-        Applies ensemble logic to determine the warning level.
+        n, head = buf['n'], buf['head']
+        x_out, y_out = buf['x_out'], buf['y_out']
+        if n < MAX_PLOT_POINTS:
+            # Not wrapped yet: the valid points are already contiguous
+            x_out[:n] = buf['x'][:n]
+            y_out[:n] = buf['y'][:n]
+            return x_out[:n], y_out[:n]
+        tail = MAX_PLOT_POINTS - head
+        x_out[:tail] = buf['x'][head:]
+        x_out[tail:] = buf['x'][:head]
+        y_out[:tail] = buf['y'][head:]
+        y_out[tail:] = buf['y'][:head]
+        return x_out, y_out
+
+
+    def _set_plot_label(self, plot_obj, plot_item, plot_label):
+        """Renames a line series and its existing legend entry."""
+        plot_item.opts['name'] = plot_label
+        legend_label = plot_obj.legend.getLabel(plot_item) if plot_obj.legend is not None else None
+        if legend_label is not None:
+            legend_label.setText(plot_label)
+
+    def _emit_tick_row(self, node_id, data_to_process, current_python_time, ts_str, rows):
+        """Queues one node's CSV row for this tick, updates its plots and records any alert markers.
+
+        Shared by the success and fetch-failure paths; plot items are repainted later by _redraw_dirty().
+        """
+        plot_label = data_to_process['mac'] if data_to_process['mac'] is not None else f"Node {node_id}"
+
+        # --- Log to CSV ---
+        if self.csv_writer:
+            row = [
+                ts_str,
+                data_to_process['mac'] if data_to_process['mac'] is not None else f"Node {data_to_process['nodeId']}",
+                data_to_process['rain'] if data_to_process['rain'] is not None else '',
+                data_to_process['soil'] if data_to_process['soil'] is not None else '',
+                data_to_process['vibration'] if data_to_process['vibration'] is not None else '',
+                data_to_process['tilt'] if data_to_process['tilt'] is not None else '',
+                data_to_process['iso_score'] if data_to_process['iso_score'] is not None else '',
+                data_to_process['river_score'] if data_to_process['river_score'] is not None else '',
+                data_to_process['warning_level_numerical'],
+                data_to_process['warning_level_text']
+            ]
+            rows.append(row)
+
+        # Only touch the legend when the node's label actually changes (e.g. its MAC becomes known)
+        label_changed = self._node_labels.get(node_id, plot_label) != plot_label
+        self._node_labels[node_id] = plot_label
+
+        # --- Update Plot Data & Plot Items ---
+        for sensor_type, plot_obj in self._sensor_plot_pairs:
+            if node_id not in self.plot_items[sensor_type]:
+                self.plot_data[sensor_type][node_id] = self._new_plot_buffer(current_python_time)
+                self.plot_items[sensor_type][node_id] = plot_obj.plot(
+                    pen=self._node_pen(node_id),
+                    name=plot_label
+                )
+            elif label_changed:
+                self._set_plot_label(plot_obj, self.plot_items[sensor_type][node_id], plot_label)
+
+            # Special handling for warning_level: plotted as a number, and only on change
+            if sensor_type == 'warning_level':
+                if self._append_warning_point(node_id, current_python_time, data_to_process['warning_level_numerical']):
+                    self._dirty.add((sensor_type, node_id))
+                continue
+
+            # Value for plotting (use np.nan if None)
+            plot_value = data_to_process.get(sensor_type)
+            if plot_value is None:
+                plot_value = np.nan
+
+            # Ring buffer keeps only the last MAX_PLOT_POINTS points without reallocating
+            self._append_plot_point(self.plot_data[sensor_type][node_id], current_python_time, plot_value)
+
+            self._dirty.add((sensor_type, node_id))
+
+        # --- Add Alert Markings ---
+        # Scatter plot for anomalies on score plots
+        relative_time = current_python_time - self.plot_data['rain'][node_id]['t0']
+
+        # For Isolation Forest (score < threshold is anomalous)
+        if data_to_process['iso_score'] is not None and data_to_process['iso_score'] < ISO_ANOMALY_THRESHOLD:
+            self._add_alert_spot('iso_score_alert', node_id,
+                {'pos': (relative_time, data_to_process['iso_score']), 'data': node_id}
+            )
+
+        # For River HalfSpaceTrees (score > threshold is anomalous)
+        if data_to_process['river_score'] is not None and data_to_process['river_score'] > RIVER_ANOMALY_THRESHOLD:
+            self._add_alert_spot('river_score_alert', node_id,
+                {'pos': (relative_time, data_to_process['river_score']), 'data': node_id}
+            )
+
+        # For Ensemble Warning Level
+        level = data_to_process['warning_level_numerical']
+        if level > 0: # If Mid or High
+            symbol = 't' if level == 1 else 'd' # Triangle for Mid, Diamond for High
+            brush_color = self._brush_mid if level == 1 else self._brush_high
+            self._add_alert_spot('ensemble_alert', node_id,
+                {'pos': (relative_time, level), 'symbol': symbol, 'brush': brush_color, 'data': node_id}
+            )
+
+    def get_warning_levels(self, iso_scores, river_scores):
+        """
+        Applies ensemble logic to determine the warning level for a whole tick at once.
         This is a placeholder for your Logic Voting / Weighted Average / Thresholding.
-        Returns: (numerical_level, text_level)
+        Scores are float arrays with np.nan where a model produced no score.
+        Returns: int array of numerical levels (index into WARNING_LEVEL_TEXT)
         """
-        # Example Thresholds (These should be tuned based on your data and models)
         # For Isolation Forest: Lower score means more anomalous.
         # For HalfSpaceTrees: Higher score means more anomalous.
+        # Both models agree -> 2 (High), one model indicates anomaly -> 1 (Mid), neither -> 0 (Low)
+        levels = np.empty(iso_scores.size, dtype=np.int64)
+        warn_levels(iso_scores, river_scores, ISO_ANOMALY_THRESHOLD, RIVER_ANOMALY_THRESHOLD, levels)
+        return levels
+
+    def _on_data(self, current_python_time, received_data):
+        """Logs a freshly fetched payload to CSV, runs the models, and updates plots (GUI thread)."""
+        self._inflight = False
+        if self._closing:
+            return # Reply to a fetch that was still in flight when the window closed
+        if not self.csv_file: # Ensure CSV is open if not already
+            self.open_csv()
 
-        iso_anomaly_threshold = -0.05 # Values below this are considered anomalous by IF
-        river_anomaly_threshold = 20   # Values above this are considered anomalous by River
+        # Convert received_data from list of dicts to a dict keyed by nodeId for easier lookup
+        received_data_map = {item['nodeId']: item for item in received_data}
+
+        # Update last_known_data with newly received data
+        for node_id, data in received_data_map.items():
+            self.last_known_data[node_id] = {
+                'timestamp': current_python_time, # Use Python's time for consistency
+                'rain': data.get('rain'),
+                'soil': data.get('soil'),
+                'vibration': data.get('vibration'),
+                'tilt': data.get('tilt'),
+                'mac': data.get('mac') # Store MAC address
+            }
+
+        # Refresh the cached plotting order only when a node reports for the first time
+        if not self._known_ids.issuperset(received_data_map):
+            self._known_ids.update(received_data_map)
+            self._sorted_node_ids = tuple(sorted(self._known_ids))
+
+        # Process data for all known nodes (including those not currently sending)
+        tick_data = {} # {node_id: data_to_process}, in plotting order
+        ready_ids = [] # Nodes with a complete feature vector this tick
+        ready_pos = [] # Their positions within tick_data (feature rows live in self._X_buf)
+        
+        for node_id in self._sorted_node_ids: # Sorted for consistent plotting order
+            data_to_process = _EMPTY_ROW.copy()
+            data_to_process['nodeId'] = node_id
+
+            # --- Handle data acquisition (direct or forward-filled) ---
+            if node_id in received_data_map:
+                # Use directly received data
+                data_to_process['rain'] = received_data_map[node_id]['rain']
+                data_to_process['soil'] = received_data_map[node_id]['soil']
+                data_to_process['vibration'] = received_data_map[node_id]['vibration']
+                data_to_process['tilt'] = received_data_map[node_id]['tilt']
+                data_to_process['mac'] = received_data_map[node_id]['mac']
+            elif self.current_mode == "STANDBY_MODE" and node_id in self.last_known_data:
+                # Apply forward filling for standby mode if data is within timeout
+                last_update_time = self.last_known_data[node_id].get('timestamp')
+                if last_update_time is not None and \
+                   (current_python_time - last_update_time) <= FORWARD_FILL_TIMEOUT_SECONDS:
+                    # Use last known values
+                    data_to_process['rain'] = self.last_known_data[node_id]['rain']
+                    data_to_process['soil'] = self.last_known_data[node_id]['soil']
+                    data_to_process['vibration'] = self.last_known_data[node_id]['vibration']
+                    data_to_process['tilt'] = self.last_known_data[node_id]['tilt']
+                    data_to_process['mac'] = self.last_known_data[node_id]['mac'] # Forward fill MAC too
+                else:
+                    # Data is too old for forward filling, set to None (NaN in plot)
+                    # MAC address might still be known from last_known_data, even if sensor data is stale
+                    data_to_process['mac'] = self.last_known_data[node_id].get('mac')
 
-        is_iso_anomaly = iso_score is not None and iso_score < iso_anomaly_threshold
-        is_river_anomaly = river_score is not None and river_score > river_anomaly_threshold
 
-        if is_iso_anomaly and is_river_anomaly:
-            return (2, "High") # Both models agree
-        elif is_iso_anomaly or is_river_anomaly:
-            return (1, "Mid") # One model indicates anomaly
-        else:
-            return (0, "Low") # Neither indicates anomaly
+            # --- Feature Extraction ---
+            # Only proceed if all sensor data (rain, soil, vibration, tilt) is available and models are loaded
+            if all(data_to_process[k] is not None for k in ['rain', 'soil', 'vibration', 'tilt']) and \
+               self.if_model and self.scaler and self.mac_encoder:
+                
+                # Encode MAC Address for the models
+                encoded_mac = None
+                if data_to_process['mac'] is not None:
+                    # O(1) dict lookup instead of LabelEncoder.transform on every row
+                    encoded_mac = self._mac_to_id.get(data_to_process['mac'])
+                    if encoded_mac is None:
+                        # Handle new MACs not seen during training for LabelEncoder
+                        # Assign a new, unique integer for this new MAC.
+                        # This is a simple approach; for robust production, consider
+                        # retraining the encoder or using a hashing trick.
+                        # For now, we'll remember the new id (persisted by save_state).
+                        encoded_mac = len(self._mac_to_id)
+                        self._mac_to_id[data_to_process['mac']] = encoded_mac
+                        self._mac_extra.append(data_to_process['mac'])
+                        print(f"Info: Added new MAC '{data_to_process['mac']}' to encoder classes for Node {node_id}. New encoded value: {encoded_mac}")
+                else:
+                    # If MAC is None (e.g., during forward fill where MAC wasn't known yet)
+                    # or if there's a problem, use a default/placeholder for encoded_mac.
+                    # This might affect model accuracy for such points.
+                    encoded_mac = 0 # Default if MAC is missing
+
+                # Write the input features straight into the preallocated float32 matrix
+                k = len(ready_ids)
+                if k == len(self._X_buf): # More reporting nodes than MAX_NODES: grow the matrix
+                    self._X_buf = np.concatenate((self._X_buf, np.empty_like(self._X_buf)))
+                features = self._X_buf[k]
+                features[0] = data_to_process['rain']
+                features[1] = data_to_process['soil']
+                features[2] = data_to_process['vibration']
+                features[3] = data_to_process['tilt']
+                features[4] = encoded_mac # Add encoded MAC as a feature
+
+                ready_ids.append(node_id)
+                ready_pos.append(len(tick_data))
+            else:
+                # If data is incomplete or models not loaded, scores remain None
+                pass # Already initialized to None or default values
+
+            tick_data[node_id] = data_to_process
+
+        iso_scores = np.full(len(tick_data), np.nan)
+        river_scores = np.full(len(tick_data), np.nan)
+
+        # --- Anomaly Detection ---
+        # Score every ready node in one call: for a handful of rows, sklearn's per-call
+        # validation/dispatch overhead dwarfs the actual tree traversal.
+        if ready_ids:
+            X = self._X_buf[:len(ready_ids)] # Rows: [rain, soil, vibration, tilt, encoded_mac]
+
+            # --- Isolation Forest Score ---
+            # Apply the same scaler used during training, as a fused NumPy expression on the
+            # cached float32 parameters (skips StandardScaler.transform's per-call validation)
+            Xs = (X - self._mean) * self._inv_scale
+            if self._fil is not None:
+                # The compiled forest outputs -score_samples; shift by offset_ to get decision_function
+                scores = -self._fil.predict(tl2cgen.DMatrix(Xs)).ravel() - self.if_model.offset_
+            else:
+                # Trees are scored in parallel only inside an explicit joblib backend context;
+                # the threading backend avoids process start-up and pickling costs per tick.
+                with parallel_backend('threading', n_jobs=IF_PREDICT_THREADS):
+                    scores = self.if_model.decision_function(Xs)
+            iso_scores[ready_pos] = scores
 
+            for k, (node_id, pos) in enumerate(zip(ready_ids, ready_pos)):
+                data_to_process = tick_data[node_id]
+                data_to_process['iso_score'] = scores[k]
 
-    def fetch_and_update_data(self):
-        """Fetches data from ESP32, logs to CSV, and updates plots."""
-        current_python_time = time.time() # Current time in seconds since epoch
+                # --- River HalfSpaceTrees Score (predict and learn) ---
+                # HalfSpaceTrees takes the raw (unscaled) feature row, encoded MAC included,
+                # and learns incrementally. Scoring happens first, then learning from the observation.
+                data_to_process['river_score'] = self.river_model.score_and_learn(X[k])
+                river_scores[pos] = data_to_process['river_score']
+
+        # --- Ensemble Logic (Warning Level) ---
+        warning_levels = self.get_warning_levels(iso_scores, river_scores)
+
+        # Every row of this tick shares the same timestamp, so format it once
+        ts_str = datetime.fromtimestamp(current_python_time).strftime("%Y-%m-%d %H:%M:%S.%f")
+        rows = [] # CSV rows for this tick, written with a single writerows() call
+
+        for (node_id, data_to_process), level in zip(tick_data.items(), warning_levels):
+            data_to_process['warning_level_numerical'] = int(level)
+            data_to_process['warning_level_text'] = WARNING_LEVEL_TEXT[level]
+
+            self._emit_tick_row(node_id, data_to_process, current_python_time, ts_str, rows)
 
+        if self.csv_writer and rows:
+            self._queue_csv_rows(rows)
+        
+        # Update the mode label if it's currently unknown (first fetch)
+        if self.current_mode == "UNKNOWN" and received_data:
+            self.mode_label.setText(f"Current Mode: {self.current_mode} (Data Received)")
+
+    def _on_fetch_failed(self, current_python_time, error):
+        """Handles a failed fetch, forward-filling known nodes in Standby Mode (GUI thread)."""
+        self._inflight = False
+        if self._closing:
+            return # Reply to a fetch that was still in flight when the window closed
         if not self.csv_file: # Ensure CSV is open if not already
             self.open_csv()
 
-        try:
-            response = requests.get(SENSOR_DATA_ENDPOINT, timeout=FETCH_INTERVAL_MS / 1000.0 + 1) # Add a buffer to timeout
-            response.raise_for_status()
-            received_data = response.json()
-
-            # Convert received_data from list of dicts to a dict keyed by nodeId for easier lookup
-            received_data_map = {item['nodeId']: item for item in received_data}
-
-            # Update last_known_data with newly received data
-            for node_id, data in received_data_map.items():
-                self.last_known_data[node_id] = {
-                    'timestamp': current_python_time, # Use Python's time for consistency
-                    'rain': data.get('rain'),
-                    'soil': data.get('soil'),
-                    'vibration': data.get('vibration'),
-                    'tilt': data.get('tilt'),
-                    'mac': data.get('mac') # Store MAC address
-                }
-
-            # Process data for all known nodes (including those not currently sending)
-            all_node_ids = set(self.last_known_data.keys()).union(set(received_data_map.keys()))
-            
-            for node_id in sorted(list(all_node_ids)): # Sort for consistent plotting order
-                data_to_process = {
-                    'nodeId': node_id,
-                    'rain': None,
-                    'soil': None,
-                    'vibration': None,
-                    'tilt': None,
-                    'mac': None,
-                    'iso_score': None,
-                    'river_score': None,
-                    'warning_level_numerical': 0, # Default to Low
-                    'warning_level_text': "Low"
-                }
-
-                # --- Handle data acquisition (direct or forward-filled) ---
-                if node_id in received_data_map:
-                    # Use directly received data
-                    data_to_process['rain'] = received_data_map[node_id]['rain']
-                    data_to_process['soil'] = received_data_map[node_id]['soil']
-                    data_to_process['vibration'] = received_data_map[node_id]['vibration']
-                    data_to_process['tilt'] = received_data_map[node_id]['tilt']
-                    data_to_process['mac'] = received_data_map[node_id]['mac']
-                elif self.current_mode == "STANDBY_MODE" and node_id in self.last_known_data:
-                    # Apply forward filling for standby mode if data is within timeout
-                    last_update_time = self.last_known_data[node_id].get('timestamp')
-                    if last_update_time is not None and \
-                       (current_python_time - last_update_time) <= FORWARD_FILL_TIMEOUT_SECONDS:
-                        # Use last known values
-                        data_to_process['rain'] = self.last_known_data[node_id]['rain']
-                        data_to_process['soil'] = self.last_known_data[node_id]['soil']
-                        data_to_process['vibration'] = self.last_known_data[node_id]['vibration']
-                        data_to_process['tilt'] = self.last_known_data[node_id]['tilt']
-                        data_to_process['mac'] = self.last_known_data[node_id]['mac'] # Forward fill MAC too
-                    else:
-                        # Data is too old for forward filling, set to None (NaN in plot)
-                        # MAC address might still be known from last_known_data, even if sensor data is stale
-                        data_to_process['mac'] = self.last_known_data[node_id].get('mac')
-
-
-                # --- Anomaly Detection ---
-                # Only proceed if all sensor data (rain, soil, vibration, tilt) is available and models are loaded
-                if all(data_to_process[k] is not None for k in ['rain', 'soil', 'vibration', 'tilt']) and \
-                   self.if_model and self.scaler and self.mac_encoder:
-                    
-                    # Create input feature array for models
-                    # Note: Vibration and Tilt are already floats from ESP32 JSON, but ensure consistency
-                    features_list = [
-                        float(data_to_process['rain']),
-                        float(data_to_process['soil']),
-                        float(data_to_process['vibration']),
-                        float(data_to_process['tilt'])
-                    ]
-                    
-                    # Encode MAC Address for the models
-                    encoded_mac = None
-                    if data_to_process['mac'] is not None:
-                        try:
-                            # Handle new MACs not seen during training for LabelEncoder
-                            if data_to_process['mac'] not in self.mac_encoder.classes_:
-                                # Assign a new, unique integer for this new MAC.
-                                # This is a simple approach; for robust production, consider
-                                # retraining the encoder or using a hashing trick.
-                                # For now, we'll append to classes and transform.
-                                self.mac_encoder.classes_ = np.append(self.mac_encoder.classes_, data_to_process['mac'])
-                                encoded_mac = self.mac_encoder.transform([data_to_process['mac']])[0]
-                                print(f"Info: Added new MAC '{data_to_process['mac']}' to encoder classes for Node {node_id}. New encoded value: {encoded_mac}")
-                            else:
-                                encoded_mac = self.mac_encoder.transform([data_to_process['mac']])[0]
-                        except Exception as e:
-                            print(f"Error encoding MAC '{data_to_process['mac']}': {e}. Defaulting encoded_mac to 0.")
-                            encoded_mac = 0 # Fallback if encoding fails
-                    else:
-                        # If MAC is None (e.g., during forward fill where MAC wasn't known yet)
-                        # or if there's a problem, use a default/placeholder for encoded_mac.
-                        # This might affect model accuracy for such points.
-                        encoded_mac = 0 # Default if MAC is missing
-
-                    features_list.append(float(encoded_mac)) # Add encoded MAC as a feature
-
-                    input_array = np.array(features_list).reshape(1, -1)
-
-                    # --- Isolation Forest Score ---
-                    # Apply the same scaler used during training
-                    if self.scaler:
-                        scaled_input = self.scaler.transform(input_array)
-                        data_to_process['iso_score'] = self.if_model.decision_function(scaled_input)[0]
-                    else:
-                        print("Warning: Scaler not loaded. Cannot calculate Isolation Forest score.")
-
-                    # --- River HalfSpaceTrees Score (predict and learn) ---
-                    # HalfSpaceTrees expects a dictionary input, not scaled numpy array,
-                    # and it learns incrementally.
-                    # It's better to provide raw features to river and let it do its internal preprocessing.
-                    river_input = {
-                        'rain': data_to_process['rain'],
-                        'soil': data_to_process['soil'],
-                        'vibration': data_to_process['vibration'],
-                        'tilt': data_to_process['tilt'],
-                        'encoded_mac': float(encoded_mac) # Use encoded MAC for river as well
-                    }
-                    # Make a prediction (score) first, then learn from the observation
-                    data_to_process['river_score'] = self.river_model.score_one(river_input)
-                    self.river_model.learn_one(river_input)
+        print(f"Error fetching data: {error}")
+        # If data fetch fails, apply forward filling for all nodes if in standby mode
+        if self.current_mode == "STANDBY_MODE":
+            ts_str = datetime.fromtimestamp(current_python_time).strftime("%Y-%m-%d %H:%M:%S.%f")
+            rows = [] # CSV rows for this tick, written with a single writerows() call
+            for node_id in self._sorted_node_ids: # Same cached order as the success path
+                data_to_process = _EMPTY_ROW.copy()
+                data_to_process['nodeId'] = node_id
+                last_update_time = self.last_known_data[node_id].get('timestamp')
+                if last_update_time is not None and \
+                   (current_python_time - last_update_time) <= FORWARD_FILL_TIMEOUT_SECONDS:
+                    data_to_process['rain'] = self.last_known_data[node_id]['rain']
+                    data_to_process['soil'] = self.last_known_data[node_id]['soil']
+                    data_to_process['vibration'] = self.last_known_data[node_id]['vibration']
+                    data_to_process['tilt'] = self.last_known_data[node_id]['tilt']
+                    data_to_process['mac'] = self.last_known_data[node_id]['mac']
                 else:
-                    # If data is incomplete or models not loaded, scores remain None
-                    pass # Already initialized to None or default values
-
-                # --- Ensemble Logic (Warning Level) ---
-                (data_to_process['warning_level_numerical'],
-                 data_to_process['warning_level_text']) = self.get_warning_level(
-                                                                data_to_process['iso_score'],
-                                                                data_to_process['river_score']
-                                                            )
-
-                # --- Log to CSV ---
-                if self.csv_writer:
-                    row = [
-                        datetime.fromtimestamp(current_python_time).strftime("%Y-%m-%d %H:%M:%S.%f"),
-                        data_to_process['mac'] if data_to_process['mac'] is not None else f"Node {data_to_process['nodeId']}",
-                        data_to_process['rain'] if data_to_process['rain'] is not None else '',
-                        data_to_process['soil'] if data_to_process['soil'] is not None else '',
-                        data_to_process['vibration'] if data_to_process['vibration'] is not None else '',
-                        data_to_process['tilt'] if data_to_process['tilt'] is not None else '',
-                        data_to_process['iso_score'] if data_to_process['iso_score'] is not None else '',
-                        data_to_process['river_score'] if data_to_process['river_score'] is not None else '',
-                        data_to_process['warning_level_numerical'],
-                        data_to_process['warning_level_text']
-                    ]
-                    self.csv_writer.writerow(row)
-                    self.csv_file.flush() # Ensure data is written to disk immediately
-
-                # --- Update Plot Data & Plot Items ---
-                for sensor_type, plot_obj in {
-                    'rain': self.plot_rain, 'soil': self.plot_soil,
-                    'vibration': self.plot_vibration, 'tilt': self.plot_tilt,
-                    'iso_score': self.plot_iso_score, 'river_score': self.plot_river_score,
-                    'warning_level': self.plot_warning_level
-                }.items():
-                    plot_label = data_to_process['mac'] if data_to_process['mac'] is not None else f"Node {node_id}"
-
-                    if node_id not in self.plot_items[sensor_type]:
-                        self.plot_data[sensor_type][node_id] = {'x': [], 'y': []}
-                        color = pg.intColor(node_id * 10, hues=MAX_NODES)
-                        self.plot_items[sensor_type][node_id] = plot_obj.plot(
-                            pen=pg.mkPen(color=color, width=2),
-                            name=plot_label
-                        )
-                    else:
-                        current_plot_item = self.plot_items[sensor_type][node_id]
-                        if current_plot_item.name() != plot_label:
-                            current_plot_item.opts['name'] = plot_label
-                            current_plot_item.updateLabel()
-
-                    # Value for plotting (use np.nan if None)
-                    plot_value = data_to_process.get(sensor_type)
-                    if plot_value is None:
-                        plot_value = np.nan
-                    # Special handling for warning_level to ensure it's plotted as number
-                    if sensor_type == 'warning_level':
-                        plot_value = data_to_process['warning_level_numerical']
-                    
-                    self.plot_data[sensor_type][node_id]['x'].append(current_python_time)
-                    self.plot_data[sensor_type][node_id]['y'].append(plot_value)
-                    
-                    max_points = 500 # Keep only the last N points
-                    if len(self.plot_data[sensor_type][node_id]['x']) > max_points:
-                        self.plot_data[sensor_type][node_id]['x'] = self.plot_data[sensor_type][node_id]['x'][-500:] # Fixed slice to 500
-                        self.plot_data[sensor_type][node_id]['y'] = self.plot_data[sensor_type][node_id]['y'][-500:] # Fixed slice to 500
-
-                    self.plot_items[sensor_type][node_id].setData(
-                        np.array(self.plot_data[sensor_type][node_id]['x']) - self.plot_data[sensor_type][node_id]['x'][0],
-                        np.array(self.plot_data[sensor_type][node_id]['y'])
-                    )
-                
-                # --- Add Alert Markings ---
-                # Scatter plot for anomalies on score plots
-                relative_time = (current_python_time - self.plot_data['rain'][node_id]['x'][0]) if self.plot_data['rain'][node_id]['x'] else 0
+                    data_to_process['mac'] = self.last_known_data[node_id].get('mac')
                 
-                # For Isolation Forest (score < threshold is anomalous)
-                if data_to_process['iso_score'] is not None and data_to_process['iso_score'] < -0.05: # Example threshold
-                    if node_id not in self.alert_scatter_items['iso_score_alert']:
-                        self.alert_scatter_items['iso_score_alert'][node_id] = pg.ScatterPlotItem(
-                            symbol='o', size=10, brush=pg.mkBrush(255, 0, 0, 150), name=f'IF Anomaly {plot_label}'
-                        )
-                        self.plot_iso_score.addItem(self.alert_scatter_items['iso_score_alert'][node_id])
-                    self.alert_scatter_items['iso_score_alert'][node_id].addPoints(
-                        [relative_time], [data_to_process['iso_score']]
-                    )
-                
-                # For River HalfSpaceTrees (score > threshold is anomalous)
-                if data_to_process['river_score'] is not None and data_to_process['river_score'] > 20: # Example threshold
-                    if node_id not in self.alert_scatter_items['river_score_alert']:
-                        self.alert_scatter_items['river_score_alert'][node_id] = pg.ScatterPlotItem(
-                            symbol='s', size=10, brush=pg.mkBrush(0, 0, 255, 150), name=f'River Anomaly {plot_label}'
-                        )
-                        self.plot_river_score.addItem(self.alert_scatter_items['river_score_alert'][node_id])
-                    self.alert_scatter_items['river_score_alert'][node_id].addPoints(
-                        [relative_time], [data_to_process['river_score']]
-                    )
-
-                # For Ensemble Warning Level
-                if data_to_process['warning_level_numerical'] > 0: # If Mid or High
-                    symbol = 't' if data_to_process['warning_level_numerical'] == 1 else 'd' # Triangle for Mid, Diamond for High
-                    brush_color = pg.mkBrush(255, 165, 0, 150) if data_to_process['warning_level_numerical'] == 1 else pg.mkBrush(255, 0, 0, 200) # Orange for Mid, Red for High
-                    
-                    if node_id not in self.alert_scatter_items['ensemble_alert']:
-                        self.alert_scatter_items['ensemble_alert'][node_id] = pg.ScatterPlotItem(
-                            symbol=symbol, size=12, brush=brush_color, name=f'Ensemble Alert {plot_label}'
-                        )
-                        self.plot_warning_level.addItem(self.alert_scatter_items['ensemble_alert'][node_id])
-                    else:
-                        # Update existing scatter plot item attributes if necessary (e.g., symbol/color for different levels)
-                        self.alert_scatter_items['ensemble_alert'][node_id].setSymbol(symbol)
-                        self.alert_scatter_items['ensemble_alert'][node_id].setBrush(brush_color)
-
-                    self.alert_scatter_items['ensemble_alert'][node_id].addPoints(
-                        [relative_time], [data_to_process['warning_level_numerical']]
-                    )
-            
-            # Update the mode label if it's currently unknown (first fetch)
-            if self.current_mode == "UNKNOWN" and received_data:
-                self.mode_label.setText(f"Current Mode: {self.current_mode} (Data Received)")
-
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            # If data fetch fails, apply forward filling for all nodes if in standby mode
-            if self.current_mode == "STANDBY_MODE":
-                for node_id in sorted(list(self.last_known_data.keys())):
-                    data_to_process = {
-                        'nodeId': node_id,
-                        'rain': None, 'soil': None, 'vibration': None, 'tilt': None, 'mac': None,
-                        'iso_score': None, 'river_score': None,
-                        'warning_level_numerical': 0, 'warning_level_text': "Low"
-                    }
-                    last_update_time = self.last_known_data[node_id].get('timestamp')
-                    if last_update_time is not None and \
-                       (current_python_time - last_update_time) <= FORWARD_FILL_TIMEOUT_SECONDS:
-                        data_to_process['rain'] = self.last_known_data[node_id]['rain']
-                        data_to_process['soil'] = self.last_known_data[node_id]['soil']
-                        data_to_process['vibration'] = self.last_known_data[node_id]['vibration']
-                        data_to_process['tilt'] = self.last_known_data[node_id]['tilt']
-                        data_to_process['mac'] = self.last_known_data[node_id]['mac']
-                    else:
-                        data_to_process['mac'] = self.last_known_data[node_id].get('mac')
-                    
-                    # Log to CSV (even if sensor data is None, log placeholder scores/levels)
-                    if self.csv_writer:
-                        row = [
-                            datetime.fromtimestamp(current_python_time).strftime("%Y-%m-%d %H:%M:%S.%f"),
-                            data_to_process['mac'] if data_to_process['mac'] is not None else f"Node {data_to_process['nodeId']}",
-                            data_to_process['rain'] if data_to_process['rain'] is not None else '',
-                            data_to_process['soil'] if data_to_process['soil'] is not None else '',
-                            data_to_process['vibration'] if data_to_process['vibration'] is not None else '',
-                            data_to_process['tilt'] if data_to_process['tilt'] is not None else '',
-                            data_to_process['iso_score'] if data_to_process['iso_score'] is not None else '',
-                            data_to_process['river_score'] if data_to_process['river_score'] is not None else '',
-                            data_to_process['warning_level_numerical'],
-                            data_to_process['warning_level_text']
-                        ]
-                        self.csv_writer.writerow(row)
-                        self.csv_file.flush()
-
-                    # Update plot data (even if sensor data is None, plots will show NaNs or last known)
-                    for sensor_type, plot_obj in {
-                        'rain': self.plot_rain, 'soil': self.plot_soil,
-                        'vibration': self.plot_vibration, 'tilt': self.plot_tilt,
-                        'iso_score': self.plot_iso_score, 'river_score': self.plot_river_score,
-                        'warning_level': self.plot_warning_level
-                    }.items():
-                        plot_label = data_to_process['mac'] if data_to_process['mac'] is not None else f"Node {node_id}"
-
-                        if node_id not in self.plot_items[sensor_type]:
-                            self.plot_data[sensor_type][node_id] = {'x': [], 'y': []}
-                            color = pg.intColor(node_id * 10, hues=MAX_NODES)
-                            self.plot_items[sensor_type][node_id] = plot_obj.plot(
-                                pen=pg.mkPen(color=color, width=2),
-                                name=plot_label
-                            )
-                        else:
-                            current_plot_item = self.plot_items[sensor_type][node_id]
-                            if current_plot_item.name() != plot_label:
-                                current_plot_item.opts['name'] = plot_label
-                                current_plot_item.updateLabel()
-                        
-                        plot_value = data_to_process.get(sensor_type)
-                        if plot_value is None:
-                            plot_value = np.nan
-                        if sensor_type == 'warning_level':
-                            plot_value = data_to_process['warning_level_numerical']
-                        
-                        self.plot_data[sensor_type][node_id]['x'].append(current_python_time)
-                        self.plot_data[sensor_type][node_id]['y'].append(plot_value)
-                        
-                        max_points = 500
-                        if len(self.plot_data[sensor_type][node_id]['x']) > max_points:
-                            self.plot_data[sensor_type][node_id]['x'] = self.plot_data[sensor_type][node_id]['x'][-500:] # Fixed slice to 500
-                            self.plot_data[sensor_type][node_id]['y'] = self.plot_data[sensor_type][node_id]['y'][-500:] # Fixed slice to 500
-
-                        self.plot_items[sensor_type][node_id].setData(
-                            np.array(self.plot_data[sensor_type][node_id]['x']) - self.plot_data[sensor_type][node_id]['x'][0],
-                            np.array(self.plot_data[sensor_type][node_id]['y'])
-                        )
-            else:
-                # If not in STANDBY_MODE, and fetch fails, just print error and don't forward fill
-                pass
+                self._emit_tick_row(node_id, data_to_process, current_python_time, ts_str, rows)
+
+            if self.csv_writer and rows:
+                self._queue_csv_rows(rows)
+        else:
+            # If not in STANDBY_MODE, and fetch fails, just print error and don't forward fill
+            pass
 
 
     def closeEvent(self, event):
-        """Ensures the CSV file is closed when the application exits."""
+        """Stops the polling and CSV writer threads and closes the CSV file and HTTP session when the application exits."""
+        self._closing = True # Before the worker stops, so its last queued signal cannot reopen the CSV
+        self.timer.stop()
+        self.redraw_timer.stop()
+        self.net_thread.quit()
+        self.net_thread.wait()
         self.close_csv()
+        self._csv_queue.put(None) # Stop the CSV writer thread
+        self._csv_thread.join()
+        self.http.close()
+        self.save_state()
         super().closeEvent(event)
 
 if __name__ == "__main__":
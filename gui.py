@@ -1,11 +1,15 @@
 import sys
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import orjson
 import csv
 import time
+import queue
+import threading
 from datetime import datetime
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QComboBox
-from PyQt5.QtCore import QTimer, Qt
+from PyQt5.QtCore import QTimer, Qt, QObject, QThread, pyqtSignal, pyqtSlot
 import pyqtgraph as pg
 import numpy as np
 
@@ -17,12 +21,60 @@ FETCH_INTERVAL_MS = 500  # How often to fetch data from ESP32 (in milliseconds)
 FORWARD_FILL_TIMEOUT_SECONDS = 60  # 1 minute timeout for forward filling in Standby Mode
 CSV_FILENAME_PREFIX = "sensor_data_"
 MAX_NODES = 3 # Define the maximum number of nodes for color generation
+MAX_PLOT_POINTS = 500 # Length of each per-node plot history (ring buffer size)
+REDRAW_INTERVAL_MS = 1000 # How often series appended since the last repaint are pushed to the plots
+CSV_FLUSH_EVERY_TICKS = 10 # Flush buffered CSV rows to disk every N fetch ticks
+CSV_BUFFER_BYTES = 65536 # Write buffer size for the CSV log file
+CSV_QUEUE_MAXSIZE = 10000 # Per-tick row batches the CSV writer thread may fall behind by
+# Per-node record template for one tick; copied (not rebuilt) for every node
+_EMPTY_ROW = {
+    'nodeId': None, # Keep nodeId for internal logic if needed, but use mac for display
+    'rain': None,
+    'soil': None,
+    'vibration': None,
+    'tilt': None,
+    'mac': None
+}
 
 # --- PyQtGraph Global Configuration ---
 pg.setConfigOption('background', 'w') # White background
 pg.setConfigOption('foreground', 'k') # Black foreground (text, axes)
 
+class FetcherWorker(QObject):
+    """Polls the ESP32 on a background thread so a slow HTTP round-trip never blocks the GUI."""
+    dataReady = pyqtSignal(float, object) # (python_timestamp, decoded JSON payload)
+    fetchFailed = pyqtSignal(float, str) # (python_timestamp, error message)
+    modeSet = pyqtSignal(str, object) # (requested mode, decoded JSON reply)
+    modeFailed = pyqtSignal(str) # error message
+
+    def __init__(self, http):
+        super().__init__()
+        self.http = http # Only ever used from this worker's thread; requests.Session is not thread-safe
+
+    @pyqtSlot()
+    def fetch(self):
+        current_python_time = time.time() # Current time in seconds since epoch
+        try:
+            response = self.http.get(SENSOR_DATA_ENDPOINT, timeout=FETCH_INTERVAL_MS / 1000.0 + 1) # Add a buffer to timeout
+            response.raise_for_status()
+            self.dataReady.emit(current_python_time, orjson.loads(response.content))
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            self.fetchFailed.emit(current_python_time, str(e))
+
+    @pyqtSlot(str)
+    def set_mode(self, mode):
+        """Sends a TCP request to the ESP32 to change its operating mode."""
+        try:
+            response = self.http.get(f"{SET_MODE_ENDPOINT}?mode={mode}", timeout=5)
+            response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+            self.modeSet.emit(mode, orjson.loads(response.content))
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            self.modeFailed.emit(str(e))
+
 class SensorDataApp(QWidget):
+    fetchRequested = pyqtSignal() # Asks the FetcherWorker for one poll
+    modeRequested = pyqtSignal(str) # Asks the FetcherWorker to switch the ESP32's mode
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("ESP32 Sensor Monitor")
@@ -32,12 +84,28 @@ class SensorDataApp(QWidget):
         self.csv_file = None
         self.csv_writer = None
         self.csv_filename = None
+        self._inflight = False # True while a fetch is outstanding on the worker thread
+        self._closing = False # Set by closeEvent; replies still queued from the worker are then ignored
+        # CSV rows are written by a background thread; the GUI thread only queues each tick's batch.
+        # close_csv() drains the queue before swapping files, so the writer only ever sees an open file.
+        self._csv_queue = queue.Queue(maxsize=CSV_QUEUE_MAXSIZE)
+        self._csv_thread = threading.Thread(target=self._csv_worker, daemon=True)
+        self._csv_thread.start()
+        self._dirty = set() # (sensor_type, node_id) series appended to since the last repaint
+        self._node_labels = {} # {node_id: legend label currently shown for the node's series}
+        # Line pens for every node the receiver can report (nodes are numbered 1..MAX_NODES),
+        # built once so plot creation never goes through intColor/mkPen
+        self._node_pens = {node_id: pg.mkPen(color=pg.intColor(node_id * 10, hues=MAX_NODES), width=2)
+                           for node_id in range(1, MAX_NODES + 1)}
 
         # Stores the last received data for each node, used for forward filling
         # Format: {node_id: {'timestamp': python_timestamp, 'rain': val, 'soil': val, 'vibration': val, 'tilt': val, 'mac': mac_address}}
         self.last_known_data = {}
+        # Node ids seen so far, plus the same ids as a sorted tuple (rebuilt only when a new node appears)
+        self._known_ids = set()
+        self._sorted_node_ids = ()
 
-        # Data for plotting: {sensor_type: {node_id: {'x': [], 'y': []}}}
+        # Data for plotting: {sensor_type: {node_id: ring buffer from _new_plot_buffer()}}
         self.plot_data = {
             'rain': {},
             'soil': {},
@@ -52,6 +120,14 @@ class SensorDataApp(QWidget):
             'tilt': {}
         }
 
+        # Persistent HTTP session so every poll reuses the same keep-alive TCP connection
+        # to the ESP32 instead of paying a fresh handshake each tick. One pooled connection is
+        # enough: polls and mode changes are all sent one at a time from the worker thread.
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        self.http.mount("http://", adapter)
+        self.http.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
+
         self.init_ui()
         self.start_data_timer()
 
@@ -102,40 +178,81 @@ class SensorDataApp(QWidget):
         self.plot_tilt.setLabel('left', 'Tilt (degrees)')
         self.plot_tilt.setYRange(0.0, 60.0) # Set Y-axis range for Tilt
 
+        # (sensor_type, plot) pairs in display order, built once for the per-node update loops
+        self._sensor_plot_pairs = [
+            ('rain', self.plot_rain), ('soil', self.plot_soil),
+            ('vibration', self.plot_vibration), ('tilt', self.plot_tilt)
+        ]
+        for _, plot_obj in self._sensor_plot_pairs:
+            # Paint at most one min/max pair per pixel column and skip points outside the view
+            plot_obj.setDownsampling(ds=True, auto=True, mode='peak')
+            plot_obj.setClipToView(True)
+
         self.setLayout(main_layout)
 
     def start_data_timer(self):
+        # HTTP polling lives on its own thread; decoded payloads are handed back to the GUI thread
+        # through signals, so pyqtgraph items are only ever touched here.
+        self.net_thread = QThread(self)
+        self.fetcher = FetcherWorker(self.http)
+        self.fetcher.moveToThread(self.net_thread)
+        self.fetcher.dataReady.connect(self._on_data)
+        self.fetcher.fetchFailed.connect(self._on_fetch_failed)
+        self.fetcher.modeSet.connect(self._on_mode_set)
+        self.fetcher.modeFailed.connect(self._on_mode_failed)
+        self.fetchRequested.connect(self.fetcher.fetch, Qt.QueuedConnection)
+        self.modeRequested.connect(self.fetcher.set_mode, Qt.QueuedConnection)
+        self.net_thread.start()
+
         self.timer = QTimer()
+        self.timer.setTimerType(Qt.PreciseTimer)
         self.timer.setInterval(FETCH_INTERVAL_MS)
-        self.timer.timeout.connect(self.fetch_and_update_data)
+        self.timer.timeout.connect(self._request_fetch)
         self.timer.start()
 
+        # Repaints run on their own, slower timer so rendering cost does not scale with the poll rate
+        self.redraw_timer = QTimer()
+        self.redraw_timer.setInterval(REDRAW_INTERVAL_MS)
+        self.redraw_timer.timeout.connect(self._redraw_dirty)
+        self.redraw_timer.start()
+
+    def _request_fetch(self):
+        """Timer slot: polls the ESP32 unless the previous request is still in flight."""
+        if self._inflight:
+            return # Skip this tick instead of queueing requests behind a slow ESP32
+        self._inflight = True
+        self.fetchRequested.emit()
+
     def set_mode(self, mode):
-        """Sends a TCP request to the ESP32 to change its operating mode."""
-        try:
-            response = requests.get(f"{SET_MODE_ENDPOINT}?mode={mode}", timeout=5)
-            response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-            data = response.json()
-            if data.get("status") == "success":
-                self.current_mode = mode.upper() + "_MODE"
-                self.mode_label.setText(f"Current Mode: {self.current_mode}")
-                print(f"Successfully set ESP32 to {self.current_mode}")
-                # Clear existing plot data when mode changes to avoid misleading graphs
-                self.clear_plot_data()
-                # Re-initialize CSV for new mode
-                self.close_csv()
-                self.open_csv()
-            else:
-                print(f"Failed to set mode: {data.get('error', 'Unknown error')}")
-        except requests.exceptions.RequestException as e:
-            print(f"Error setting mode: {e}")
+        """Asks the worker thread to change the ESP32's operating mode; the reply arrives in _on_mode_set."""
+        self.modeRequested.emit(mode)
+
+    def _on_mode_set(self, mode, data):
+        """Applies the ESP32's reply to a mode change request (GUI thread)."""
+        if self._closing:
+            return
+        if data.get("status") == "success":
+            self.current_mode = mode.upper() + "_MODE"
+            self.mode_label.setText(f"Current Mode: {self.current_mode}")
+            print(f"Successfully set ESP32 to {self.current_mode}")
+            # Clear existing plot data when mode changes to avoid misleading graphs
+            self.clear_plot_data()
+            # Re-initialize CSV for new mode
+            self.close_csv()
+            self.open_csv()
+        else:
+            print(f"Failed to set mode: {data.get('error', 'Unknown error')}")
+
+    def _on_mode_failed(self, error):
+        """Reports a failed mode change request (GUI thread)."""
+        print(f"Error setting mode: {error}")
 
     def open_csv(self):
         """Opens a new CSV file with a timestamp in its name."""
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         self.csv_filename = f"{CSV_FILENAME_PREFIX}{timestamp}.csv"
         try:
-            self.csv_file = open(self.csv_filename, 'w', newline='')
+            self.csv_file = open(self.csv_filename, 'w', newline='', buffering=CSV_BUFFER_BYTES)
             self.csv_writer = csv.writer(self.csv_file)
             # Write header, now with "MAC Address" instead of "NodeID"
             header = ["Timestamp", "MAC Address", "Rain", "Soil", "Vibration", "Tilt"]
@@ -149,239 +266,279 @@ class SensorDataApp(QWidget):
     def close_csv(self):
         """Closes the current CSV file."""
         if self.csv_file:
+            self._csv_queue.join() # Let the writer thread finish every queued row first
             self.csv_file.close()
             print(f"Closed CSV file: {self.csv_filename}")
             self.csv_file = None
             self.csv_writer = None
             self.csv_filename = None
 
+    def _queue_csv_rows(self, rows):
+        """Hands one tick's CSV rows to the writer thread without blocking the GUI thread."""
+        try:
+            self._csv_queue.put_nowait(rows)
+        except queue.Full:
+            print(f"CSV writer is falling behind; dropped {len(rows)} rows")
+
+    def _csv_worker(self):
+        """CSV writer thread: writes queued row batches, flushing once every CSV_FLUSH_EVERY_TICKS of them."""
+        flush_counter = 0
+        while True:
+            rows = self._csv_queue.get()
+            try:
+                if rows is None: # Shutdown sentinel from closeEvent
+                    return
+                self.csv_writer.writerows(rows)
+                flush_counter += 1
+                if flush_counter >= CSV_FLUSH_EVERY_TICKS:
+                    self.csv_file.flush()
+                    flush_counter = 0
+            except Exception as e: # Keep consuming so close_csv()'s queue join can never hang
+                print(f"Error writing to CSV file: {e}")
+            finally:
+                self._csv_queue.task_done()
+
+    def _redraw_dirty(self):
+        """Redraw timer slot: pushes each series appended since the last repaint to its plot item once."""
+        for sensor_type, node_id in self._dirty:
+            self.plot_items[sensor_type][node_id].setData(
+                *self._plot_arrays(self.plot_data[sensor_type][node_id])
+            )
+        self._dirty.clear()
+
     def clear_plot_data(self):
         """Clears all historical plot data and plot items."""
-        for sensor_type in self.plot_data:
+        for sensor_type, plot_obj in self._sensor_plot_pairs:
             self.plot_data[sensor_type].clear()
-            for node_id in self.plot_items[sensor_type]:
+            for plot_item in self.plot_items[sensor_type].values():
                 # Remove plot items from their respective plots
-                if sensor_type == 'rain': self.plot_rain.removeItem(self.plot_items[sensor_type][node_id])
-                elif sensor_type == 'soil': self.plot_soil.removeItem(self.plot_items[sensor_type][node_id])
-                elif sensor_type == 'vibration': self.plot_vibration.removeItem(self.plot_items[sensor_type][node_id])
-                elif sensor_type == 'tilt': self.plot_tilt.removeItem(self.plot_items[sensor_type][node_id])
+                plot_obj.removeItem(plot_item)
             self.plot_items[sensor_type].clear()
+        self._dirty.clear()
+        self._node_labels.clear()
         self.last_known_data.clear() # Also clear last known data for forward filling
+        self._known_ids.clear()
+        self._sorted_node_ids = ()
+
+    def _new_plot_buffer(self, t0):
+        """Allocates a fixed-size ring buffer (plus reusable setData output arrays) for one (sensor, node) series.
+
+        t0 is the series' time baseline: x values are stored as seconds since t0,
+        so they can be handed to setData without any per-tick arithmetic.
+        """
+        return {'x': np.empty(MAX_PLOT_POINTS), 'y': np.empty(MAX_PLOT_POINTS), 'n': 0, 'head': 0, 't0': t0,
+                'x_out': np.empty(MAX_PLOT_POINTS), 'y_out': np.empty(MAX_PLOT_POINTS)}
+
+    def _append_plot_point(self, buf, t, value):
+        """Writes a point at the ring buffer head, overwriting the oldest point once full."""
+        head = buf['head']
+        buf['x'][head] = t - buf['t0']
+        buf['y'][head] = value
+        buf['head'] = (head + 1) % MAX_PLOT_POINTS
+        buf['n'] = min(buf['n'] + 1, MAX_PLOT_POINTS)
+
+    def _plot_arrays(self, buf):
+        """Returns (relative_time, values) in chronological order, ready for setData.
+
+        The points are always copied into the buffer's preallocated output arrays, so plot
+        items never hold views into the live ring buffer and the update path does not allocate.
+        """
+        n, head = buf['n'], buf['head']
+        x_out, y_out = buf['x_out'], buf['y_out']
+        if n < MAX_PLOT_POINTS:
+            # Not wrapped yet: the valid points are already contiguous
+            x_out[:n] = buf['x'][:n]
+            y_out[:n] = buf['y'][:n]
+            return x_out[:n], y_out[:n]
+        tail = MAX_PLOT_POINTS - head
+        x_out[:tail] = buf['x'][head:]
+        x_out[tail:] = buf['x'][:head]
+        y_out[:tail] = buf['y'][head:]
+        y_out[tail:] = buf['y'][:head]
+        return x_out, y_out
+
+    def _node_pen(self, node_id):
+        """Returns the line pen for a node; ids beyond MAX_NODES get one built on first use."""
+        pen = self._node_pens.get(node_id)
+        if pen is None:
+            pen = self._node_pens[node_id] = pg.mkPen(color=pg.intColor(node_id * 10, hues=MAX_NODES), width=2)
+        return pen
+
+    def _set_plot_label(self, plot_obj, plot_item, plot_label):
+        """Renames a line series and its existing legend entry."""
+        plot_item.opts['name'] = plot_label
+        legend_label = plot_obj.legend.getLabel(plot_item) if plot_obj.legend is not None else None
+        if legend_label is not None:
+            legend_label.setText(plot_label)
+
+    def _emit_tick_row(self, node_id, data_to_log, current_python_time, ts_str, rows):
+        """Queues one node's CSV row for this tick and appends its values to the plots.
+
+        Shared by the success and fetch-failure paths; plot items are repainted later by _redraw_dirty().
+        """
+        # Determine the label for the plot legend
+        plot_label = data_to_log['mac'] if data_to_log['mac'] is not None else f"Node {node_id}"
+
+        # Log to CSV
+        if self.csv_writer:
+            row = [
+                ts_str,
+                data_to_log['mac'] if data_to_log['mac'] is not None else f"Node {data_to_log['nodeId']}", # Use MAC for CSV
+                data_to_log['rain'] if data_to_log['rain'] is not None else '',
+                data_to_log['soil'] if data_to_log['soil'] is not None else '',
+                data_to_log['vibration'] if data_to_log['vibration'] is not None else '',
+                data_to_log['tilt'] if data_to_log['tilt'] is not None else ''
+            ]
+            rows.append(row)
+
+        # Only touch the legend when the node's label actually changes (e.g. its MAC becomes known)
+        label_changed = self._node_labels.get(node_id, plot_label) != plot_label
+        self._node_labels[node_id] = plot_label
+
+        # Update plot data
+        for sensor_type, plot_obj in self._sensor_plot_pairs:
+            # Ensure the plot item and its corresponding data storage exist for this node and sensor type
+            if node_id not in self.plot_items[sensor_type]:
+                self.plot_data[sensor_type][node_id] = self._new_plot_buffer(current_python_time) # Initialize data storage
+                self.plot_items[sensor_type][node_id] = plot_obj.plot(
+                    pen=self._node_pen(node_id), # Use node_id for distinct colors
+                    name=plot_label # Use MAC for plot legend
+                )
+            elif label_changed:
+                # Update the legend name if MAC was not available initially but now is
+                self._set_plot_label(plot_obj, self.plot_items[sensor_type][node_id], plot_label)
+
+            # Add current time (relative to start) and sensor value
+            # Use np.nan for missing data for pyqtgraph to break lines
+            sensor_value = data_to_log[sensor_type] if data_to_log[sensor_type] is not None else np.nan
+
+            # Ring buffer keeps only the last MAX_PLOT_POINTS points without reallocating
+            self._append_plot_point(self.plot_data[sensor_type][node_id], current_python_time, sensor_value)
+
+            # Mark the series for the next repaint
+            self._dirty.add((sensor_type, node_id))
+
+    def _on_data(self, current_python_time, received_data):
+        """Logs a freshly fetched payload to CSV and updates plots (GUI thread)."""
+        self._inflight = False
+        if self._closing:
+            return # Reply to a fetch that was still in flight when the window closed
+        if not self.csv_file: # Ensure CSV is open if not already
+            self.open_csv()
 
-    def fetch_and_update_data(self):
-        """Fetches data from ESP32, logs to CSV, and updates plots."""
-        current_python_time = time.time() # Current time in seconds since epoch
-
+        # Convert received_data from list of dicts to a dict keyed by nodeId for easier lookup
+        received_data_map = {item['nodeId']: item for item in received_data}
+
+        # Update last_known_data with newly received data
+        for node_id, data in received_data_map.items():
+            self.last_known_data[node_id] = {
+                'timestamp': current_python_time, # Use Python's time for consistency
+                'rain': data.get('rain'),
+                'soil': data.get('soil'),
+                'vibration': data.get('vibration'),
+                'tilt': data.get('tilt'),
+                'mac': data.get('mac') # Store MAC address
+            }
+
+        # Refresh the cached plotting order only when a node reports for the first time
+        if not self._known_ids.issuperset(received_data_map):
+            self._known_ids.update(received_data_map)
+            self._sorted_node_ids = tuple(sorted(self._known_ids))
+
+        # Process data for all known nodes (including those not currently sending)
+        # This loop handles both direct received data and forward filling
+        # Every row of this tick shares the same timestamp, so format it once
+        ts_str = datetime.fromtimestamp(current_python_time).strftime("%Y-%m-%d %H:%M:%S.%f")
+        rows = [] # CSV rows for this tick, written with a single writerows() call
+        
+        for node_id in self._sorted_node_ids: # Sorted for consistent plotting order
+            data_to_log = _EMPTY_ROW.copy()
+            data_to_log['nodeId'] = node_id
+
+            if node_id in received_data_map:
+                # Use directly received data
+                data_to_log['rain'] = received_data_map[node_id]['rain']
+                data_to_log['soil'] = received_data_map[node_id]['soil']
+                data_to_log['vibration'] = received_data_map[node_id]['vibration']
+                data_to_log['tilt'] = received_data_map[node_id]['tilt']
+                data_to_log['mac'] = received_data_map[node_id]['mac']
+            elif self.current_mode == "STANDBY_MODE" and node_id in self.last_known_data:
+                # Apply forward filling for standby mode if data is within timeout
+                last_update_time = self.last_known_data[node_id].get('timestamp')
+                if last_update_time is not None and \
+                   (current_python_time - last_update_time) <= FORWARD_FILL_TIMEOUT_SECONDS:
+                    # Use last known values
+                    data_to_log['rain'] = self.last_known_data[node_id]['rain']
+                    data_to_log['soil'] = self.last_known_data[node_id]['soil']
+                    data_to_log['vibration'] = self.last_known_data[node_id]['vibration']
+                    data_to_log['tilt'] = self.last_known_data[node_id]['tilt']
+                    data_to_log['mac'] = self.last_known_data[node_id]['mac'] # Forward fill MAC too
+                else:
+                    # Data is too old for forward filling, set to None (NaN in plot)
+                    # MAC address might still be known from last_known_data, even if sensor data is stale
+                    data_to_log['mac'] = self.last_known_data[node_id].get('mac')
+
+
+            self._emit_tick_row(node_id, data_to_log, current_python_time, ts_str, rows)
+
+        if self.csv_writer and rows:
+            self._queue_csv_rows(rows)
+        
+        # Update the mode label if it's currently unknown (first fetch)
+        if self.current_mode == "UNKNOWN" and received_data:
+            # The ESP32 code doesn't send its current mode in the /sensor_data response directly.
+            # We'll rely on the user setting it via buttons or assume an initial state.
+            # For now, if data is received, we know it's active.
+            self.mode_label.setText(f"Current Mode: {self.current_mode} (Data Received)")
+
+    def _on_fetch_failed(self, current_python_time, error):
+        """Handles a failed fetch, forward-filling known nodes in Standby Mode (GUI thread)."""
+        self._inflight = False
+        if self._closing:
+            return # Reply to a fetch that was still in flight when the window closed
         if not self.csv_file: # Ensure CSV is open if not already
             self.open_csv()
 
-        try:
-            response = requests.get(SENSOR_DATA_ENDPOINT, timeout=FETCH_INTERVAL_MS / 1000.0 + 1) # Add a buffer to timeout
-            response.raise_for_status()
-            received_data = response.json()
-
-            # Convert received_data from list of dicts to a dict keyed by nodeId for easier lookup
-            received_data_map = {item['nodeId']: item for item in received_data}
-
-            # Update last_known_data with newly received data
-            for node_id, data in received_data_map.items():
-                self.last_known_data[node_id] = {
-                    'timestamp': current_python_time, # Use Python's time for consistency
-                    'rain': data.get('rain'),
-                    'soil': data.get('soil'),
-                    'vibration': data.get('vibration'),
-                    'tilt': data.get('tilt'),
-                    'mac': data.get('mac') # Store MAC address
-                }
-
-            # Process data for all known nodes (including those not currently sending)
-            # This loop handles both direct received data and forward filling
-            all_node_ids = set(self.last_known_data.keys()).union(set(received_data_map.keys()))
-            
-            for node_id in sorted(list(all_node_ids)): # Sort for consistent plotting order
-                data_to_log = {
-                    'nodeId': node_id, # Keep nodeId for internal logic if needed, but use mac for display
-                    'rain': None,
-                    'soil': None,
-                    'vibration': None,
-                    'tilt': None,
-                    'mac': None # Initialize mac
-                }
-
-                if node_id in received_data_map:
-                    # Use directly received data
-                    data_to_log['rain'] = received_data_map[node_id]['rain']
-                    data_to_log['soil'] = received_data_map[node_id]['soil']
-                    data_to_log['vibration'] = received_data_map[node_id]['vibration']
-                    data_to_log['tilt'] = received_data_map[node_id]['tilt']
-                    data_to_log['mac'] = received_data_map[node_id]['mac']
-                elif self.current_mode == "STANDBY_MODE" and node_id in self.last_known_data:
-                    # Apply forward filling for standby mode if data is within timeout
-                    last_update_time = self.last_known_data[node_id].get('timestamp')
-                    if last_update_time is not None and \
-                       (current_python_time - last_update_time) <= FORWARD_FILL_TIMEOUT_SECONDS:
-                        # Use last known values
-                        data_to_log['rain'] = self.last_known_data[node_id]['rain']
-                        data_to_log['soil'] = self.last_known_data[node_id]['soil']
-                        data_to_log['vibration'] = self.last_known_data[node_id]['vibration']
-                        data_to_log['tilt'] = self.last_known_data[node_id]['tilt']
-                        data_to_log['mac'] = self.last_known_data[node_id]['mac'] # Forward fill MAC too
-                    else:
-                        # Data is too old for forward filling, set to None (NaN in plot)
-                        # MAC address might still be known from last_known_data, even if sensor data is stale
-                        data_to_log['mac'] = self.last_known_data[node_id].get('mac')
-
-
-                # Log to CSV
-                if self.csv_writer:
-                    row = [
-                        datetime.fromtimestamp(current_python_time).strftime("%Y-%m-%d %H:%M:%S.%f"),
-                        data_to_log['mac'] if data_to_log['mac'] is not None else f"Node {data_to_log['nodeId']}", # Use MAC for CSV
-                        data_to_log['rain'] if data_to_log['rain'] is not None else '',
-                        data_to_log['soil'] if data_to_log['soil'] is not None else '',
-                        data_to_log['vibration'] if data_to_log['vibration'] is not None else '',
-                        data_to_log['tilt'] if data_to_log['tilt'] is not None else ''
-                    ]
-                    self.csv_writer.writerow(row)
-                    self.csv_file.flush() # Ensure data is written to disk immediately
-
-                # Update plot data
-                for sensor_type, plot_obj in {
-                    'rain': self.plot_rain,
-                    'soil': self.plot_soil,
-                    'vibration': self.plot_vibration,
-                    'tilt': self.plot_tilt
-                }.items():
-                    # Determine the label for the plot legend
-                    plot_label = data_to_log['mac'] if data_to_log['mac'] is not None else f"Node {node_id}"
-
-                    # Ensure the plot item and its corresponding data storage exist for this node and sensor type
-                    if node_id not in self.plot_items[sensor_type]:
-                        self.plot_data[sensor_type][node_id] = {'x': [], 'y': []} # Initialize data storage
-                        color = pg.intColor(node_id * 10, hues=MAX_NODES) # Use node_id for distinct colors
-                        self.plot_items[sensor_type][node_id] = plot_obj.plot(
-                            pen=pg.mkPen(color=color, width=2),
-                            name=plot_label # Use MAC for plot legend
-                        )
-                    else:
-                        # Update the legend name if MAC was not available initially but now is
-                        current_plot_item = self.plot_items[sensor_type][node_id]
-                        if current_plot_item.name() != plot_label:
-                            current_plot_item.opts['name'] = plot_label
-                            current_plot_item.updateLabel() # Force legend update
-
-                    # Add current time (relative to start) and sensor value
-                    # Use np.nan for missing data for pyqtgraph to break lines
-                    sensor_value = data_to_log[sensor_type] if data_to_log[sensor_type] is not None else np.nan
-                    
-                    self.plot_data[sensor_type][node_id]['x'].append(current_python_time)
-                    self.plot_data[sensor_type][node_id]['y'].append(sensor_value)
-                    
-                    # Keep only the last N points to prevent memory issues and keep plots responsive
-                    max_points = 500 # Adjust as needed
-                    if len(self.plot_data[sensor_type][node_id]['x']) > max_points:
-                        self.plot_data[sensor_type][node_id]['x'] = self.plot_data[sensor_type][node_id]['x'][-max_points:]
-                        self.plot_data[sensor_type][node_id]['y'] = self.plot_data[sensor_type][node_id]['y'][-max_points:]
-
-                    # Update plot item data
-                    self.plot_items[sensor_type][node_id].setData(
-                        np.array(self.plot_data[sensor_type][node_id]['x']) - self.plot_data[sensor_type][node_id]['x'][0],
-                        np.array(self.plot_data[sensor_type][node_id]['y'])
-                    )
-            
-            # Update the mode label if it's currently unknown (first fetch)
-            if self.current_mode == "UNKNOWN" and received_data:
-                # The ESP32 code doesn't send its current mode in the /sensor_data response directly.
-                # We'll rely on the user setting it via buttons or assume an initial state.
-                # For now, if data is received, we know it's active.
-                self.mode_label.setText(f"Current Mode: {self.current_mode} (Data Received)")
-
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            # If data fetch fails, apply forward filling for all nodes if in standby mode
-            if self.current_mode == "STANDBY_MODE":
-                for node_id in sorted(list(self.last_known_data.keys())):
-                    data_to_log = {
-                        'nodeId': node_id,
-                        'rain': None,
-                        'soil': None,
-                        'vibration': None,
-                        'tilt': None,
-                        'mac': None # Initialize mac
-                    }
-                    last_update_time = self.last_known_data[node_id].get('timestamp')
-                    if last_update_time is not None and \
-                       (current_python_time - last_update_time) <= FORWARD_FILL_TIMEOUT_SECONDS:
-                        data_to_log['rain'] = self.last_known_data[node_id]['rain']
-                        data_to_log['soil'] = self.last_known_data[node_id]['soil']
-                        data_to_log['vibration'] = self.last_known_data[node_id]['vibration']
-                        data_to_log['tilt'] = self.last_known_data[node_id]['tilt']
-                        data_to_log['mac'] = self.last_known_data[node_id]['mac']
-                    else:
-                        # MAC address might still be known from last_known_data, even if sensor data is stale
-                        data_to_log['mac'] = self.last_known_data[node_id].get('mac')
-                    
-                    # Log to CSV
-                    if self.csv_writer:
-                        row = [
-                            datetime.fromtimestamp(current_python_time).strftime("%Y-%m-%d %H:%M:%S.%f"),
-                            data_to_log['mac'] if data_to_log['mac'] is not None else f"Node {data_to_log['nodeId']}", # Use MAC for CSV
-                            data_to_log['rain'] if data_to_log['rain'] is not None else '',
-                            data_to_log['soil'] if data_to_log['soil'] is not None else '',
-                            data_to_log['vibration'] if data_to_log['vibration'] is not None else '',
-                            data_to_log['tilt'] if data_to_log['tilt'] is not None else ''
-                        ]
-                        self.csv_writer.writerow(row)
-                        self.csv_file.flush()
-
-                    # Update plot data with potentially forward-filled values
-                    for sensor_type, plot_obj in {
-                        'rain': self.plot_rain,
-                        'soil': self.plot_soil,
-                        'vibration': self.plot_vibration,
-                        'tilt': self.plot_tilt
-                    }.items():
-                        # Determine the label for the plot legend
-                        plot_label = data_to_log['mac'] if data_to_log['mac'] is not None else f"Node {node_id}"
-
-                        if node_id not in self.plot_items[sensor_type]:
-                            # This case should ideally not happen if last_known_data is populated
-                            # but added for robustness.
-                            self.plot_data[sensor_type][node_id] = {'x': [], 'y': []}
-                            color = pg.intColor(node_id * 10, hues=MAX_NODES)
-                            self.plot_items[sensor_type][node_id] = plot_obj.plot(
-                                pen=pg.mkPen(color=color, width=2),
-                                name=plot_label # Use MAC for plot legend
-                            )
-                        else:
-                            # Update the legend name if MAC was not available initially but now is
-                            current_plot_item = self.plot_items[sensor_type][node_id]
-                            if current_plot_item.name() != plot_label:
-                                current_plot_item.opts['name'] = plot_label
-                                current_plot_item.updateLabel() # Force legend update
-                        
-                        sensor_value = data_to_log[sensor_type] if data_to_log[sensor_type] is not None else np.nan
-                        self.plot_data[sensor_type][node_id]['x'].append(current_python_time)
-                        self.plot_data[sensor_type][node_id]['y'].append(sensor_value)
-                        
-                        max_points = 500
-                        if len(self.plot_data[sensor_type][node_id]['x']) > max_points:
-                            self.plot_data[sensor_type][node_id]['x'] = self.plot_data[sensor_type][node_id]['x'][-max_points:]
-                            self.plot_data[sensor_type][node_id]['y'] = self.plot_data[sensor_type][node_id]['y'][-max_points:]
-
-                        self.plot_items[sensor_type][node_id].setData(
-                            np.array(self.plot_data[sensor_type][node_id]['x']) - self.plot_data[sensor_type][node_id]['x'][0],
-                            np.array(self.plot_data[sensor_type][node_id]['y'])
-                        )
-            else:
-                # If not in STANDBY_MODE, and fetch fails, just print error and don't forward fill
-                pass
+        print(f"Error fetching data: {error}")
+        # If data fetch fails, apply forward filling for all nodes if in standby mode
+        if self.current_mode == "STANDBY_MODE":
+            ts_str = datetime.fromtimestamp(current_python_time).strftime("%Y-%m-%d %H:%M:%S.%f")
+            rows = [] # CSV rows for this tick, written with a single writerows() call
+            for node_id in self._sorted_node_ids: # Same cached order as the success path
+                data_to_log = _EMPTY_ROW.copy()
+                data_to_log['nodeId'] = node_id
+                last_update_time = self.last_known_data[node_id].get('timestamp')
+                if last_update_time is not None and \
+                   (current_python_time - last_update_time) <= FORWARD_FILL_TIMEOUT_SECONDS:
+                    data_to_log['rain'] = self.last_known_data[node_id]['rain']
+                    data_to_log['soil'] = self.last_known_data[node_id]['soil']
+                    data_to_log['vibration'] = self.last_known_data[node_id]['vibration']
+                    data_to_log['tilt'] = self.last_known_data[node_id]['tilt']
+                    data_to_log['mac'] = self.last_known_data[node_id]['mac']
+                else:
+                    # MAC address might still be known from last_known_data, even if sensor data is stale
+                    data_to_log['mac'] = self.last_known_data[node_id].get('mac')
+                
+                self._emit_tick_row(node_id, data_to_log, current_python_time, ts_str, rows)
+
+            if self.csv_writer and rows:
+                self._queue_csv_rows(rows)
+        else:
+            # If not in STANDBY_MODE, and fetch fails, just print error and don't forward fill
+            pass
 
 
     def closeEvent(self, event):
-        """Ensures the CSV file is closed when the application exits."""
+        """Stops the polling and CSV writer threads and closes the CSV file and HTTP session when the application exits."""
+        self._closing = True # Before the worker stops, so its last queued signal cannot reopen the CSV
+        self.timer.stop()
+        self.redraw_timer.stop()
+        self.net_thread.quit()
+        self.net_thread.wait()
         self.close_csv()
+        self._csv_queue.put(None) # Stop the CSV writer thread
+        self._csv_thread.join()
+        self.http.close()
         super().closeEvent(event)
 
 if __name__ == "__main__":